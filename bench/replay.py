@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""Offline replay benchmark for teacherbot.
+
+Starts a fake IRC server on the loopback interface and a BotFactory backed
+by mongomock, replays a traffic corpus through the bot and reports
+throughput, time to verdict and database operations per message as JSON.
+
+    python bench/replay.py --channels 50 --words 500 --hits 0.05 \\
+        --messages 20000 --output result.json
+
+    python bench/replay.py --compare baseline.json --tolerance 0.1
+
+A recorded corpus can be given with --corpus; it holds one raw IRC line per
+line, e.g. ":nick!user@host PRIVMSG #chan :text". Only PRIVMSG lines are
+replayed. With --compare the exit status is 1 if msgs/sec dropped or p99
+grew by more than the tolerance compared to the baseline.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import basic
+from twisted.python import usage
+
+from teacherbot import BotFactory
+from teacherbot.bot import Bot
+from teacherbot.core import Core
+from teacherbot.database import MongoBackend
+from teacherbot.settings import ChannelSettings
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class Options(usage.Options):
+    """Commandline options of the benchmark."""
+
+    optParameters = [
+        ["channels", None, 20, "Number of channels.", int],
+        ["words", None, 200, "Number of badwords per channel.", int],
+        ["hits", None, 0.05, "Share of messages with a badword.", float],
+        ["messages", None, 10000, "Number of messages to replay.", int],
+        ["rate", None, 0, "Messages per second to send, 0 for no limit.",
+            int],
+        ["users", None, 500, "Number of distinct users.", int],
+        ["corpus", None, None, "File with raw IRC lines to replay."],
+        ["seed", None, 1, "Seed for the synthetic corpus.", int],
+        ["output", "o", None, "Write the result to this file."],
+        ["compare", None, None, "Baseline result to compare against."],
+        ["tolerance", None, 0.1, "Allowed regression when comparing.",
+            float],
+        ]
+
+
+class MockBackend(MongoBackend):
+    """A MongoBackend on top of mongomock."""
+
+    def __init__(self):
+        """Init"""
+        self.client = mongomock.MongoClient()
+        self.db = self.client["teacherbot"]
+
+    def close(self):
+        """Nothing to disconnect from."""
+
+    def ensure_changes(self):
+        """mongomock has no capped collections, the feed is off here."""
+
+
+class CountingBackend(object):
+    """Wraps a backend and counts the operations run on it."""
+
+    def __init__(self, backend):
+        """Init"""
+        self.backend = backend
+        self.operations = 0
+
+    def __getattr__(self, name):
+        """Return a counting version of a backend method."""
+        func = getattr(self.backend, name)
+
+        def call(*args, **kwargs):
+            """Count and run an operation."""
+            self.operations += 1
+            return func(*args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+class BenchBot(Bot):
+    """A Bot that records when each verdict is made."""
+
+    def badword(self, result, user, channel):
+        """Record the verdict and act on it."""
+        self.factory.verdict(user, channel)
+        return Bot.badword(self, result, user, channel)
+
+    def signedOn(self):
+        """Tell the benchmark when the caches are loaded."""
+        Bot.signedOn(self)
+        self.ready.addCallback(lambda result: self.factory.signed_on.callback(
+            self))
+
+
+class BenchCore(Core):
+    """A Core using a prepared backend."""
+
+    def __init__(self, config, backend):
+        """Init"""
+        Core.__init__(self, config)
+        self.backend = backend
+
+    def make_backend(self):
+        """Use the prepared backend."""
+        return self.backend
+
+
+class BenchFactory(BotFactory):
+    """A BotFactory with the database replaced by mongomock."""
+
+    protocol = BenchBot
+
+    def __init__(self, config, backend):
+        """Init"""
+        BotFactory.__init__(self, config, core=BenchCore(config,
+            CountingBackend(backend)))
+        self.backend = self.core.backend
+        self.server = None
+        self.signed_on = defer.Deferred()
+        self.done = defer.Deferred()
+        self.sent = {}
+        self.latencies = []
+        self.expected = 0
+
+    def startFactory(self):
+        """Start the core as well."""
+        self.core.start()
+        BotFactory.startFactory(self)
+
+    def stopFactory(self):
+        """Stop the core, but not the reactor."""
+        BotFactory.stopFactory(self)
+        self.core.stop()
+
+    def verdict(self, user, channel):
+        """Called for every verdict."""
+        queue = self.sent.get((user, channel))
+
+        if queue:
+            self.latencies.append(time.time() - queue.popleft())
+
+        if len(self.latencies) == self.expected and not self.done.called:
+            self.done.callback(time.time())
+
+
+class FakeServer(basic.LineReceiver):
+    """Just enough of an IRC server to sign a client on."""
+
+    delimiter = b"\r\n"
+
+    def connectionMade(self):
+        """Let the benchmark send through this connection."""
+        self.factory.bot_factory.server = self
+
+    def lineReceived(self, line):
+        """Welcome the client and answer pings."""
+        if line.startswith(b"USER"):
+            self.sendLine(b":bench 001 BenchBot :Welcome")
+        elif line.startswith(b"PING"):
+            self.sendLine(b":bench PONG " + line.split(b" ", 1)[1])
+
+
+def synthetic_corpus(options, words):
+    """Return a list of (user, channel, text) for a synthetic workload."""
+    rand = random.Random(options["seed"])
+    filler = ("hello", "how", "are", "you", "doing", "today", "this", "is",
+        "just", "some", "normal", "chatter", "in", "the", "channel")
+    corpus = []
+
+    for i in range(options["messages"]):
+        user = "user{0}!ident{0}@host{0}.example".format(
+            rand.randrange(options["users"]))
+        channel = "#bench{}".format(rand.randrange(options["channels"]))
+        text = [rand.choice(filler) for j in range(rand.randint(3, 15))]
+
+        if rand.random() < options["hits"]:
+            text.insert(rand.randrange(len(text)), rand.choice(words))
+
+        corpus.append((user, channel, " ".join(text)))
+
+    return corpus
+
+
+def recorded_corpus(path):
+    """Return the PRIVMSG lines of a file as (user, channel, text)."""
+    corpus = []
+
+    with open(path) as f:
+        for line in f:
+            parts = line.rstrip("\r\n").split(" ", 3)
+
+            if len(parts) < 4 or parts[1] != "PRIVMSG":
+                continue
+
+            text = parts[3][1:] if parts[3].startswith(":") else parts[3]
+
+            # Commands and private messages never get a verdict.
+            if parts[2].startswith("#") and not text.startswith("@"):
+                corpus.append((parts[0].lstrip(":"), parts[2], text))
+
+    return corpus
+
+
+def seed(backend, channels, words):
+    """Fill the database with channel settings and badwords."""
+    backend.ensure_indexes()
+
+    for channel in channels:
+        settings = ChannelSettings(channel, kicker=True, ban=True)
+        backend.db.chan_settings.insert(settings.to_doc())
+        backend.db.badwords.insert([{"word": word, "channel": channel}
+            for word in words])
+
+
+def percentile(values, fraction):
+    """Return a percentile of a list of values."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@defer.inlineCallbacks
+def run(options):
+    """Run the benchmark and return the result."""
+    words = [u"badword{}".format(i) for i in range(options["words"])]
+    channels = ["#bench{}".format(i) for i in range(options["channels"])]
+
+    if options["corpus"]:
+        corpus = recorded_corpus(options["corpus"])
+        channels = sorted(set(channel for user, channel, text in corpus))
+    else:
+        corpus = synthetic_corpus(options, words)
+
+    backend = MockBackend()
+    seed(backend, channels, words)
+
+    config = {
+        "network": {"password": ""},
+        "identity": {"nickname": "BenchBot"},
+        "database": {},
+        "general": {
+            "linerate": None,
+            "queue_depth": len(corpus) + 1,
+            "change_poll": 0
+            }
+        }
+    factory = BenchFactory(config, backend)
+    factory.expected = len(corpus)
+
+    server_factory = protocol.Factory.forProtocol(FakeServer)
+    server_factory.bot_factory = factory
+    port = reactor.listenTCP(0, server_factory, interface="127.0.0.1")
+    reactor.connectTCP("127.0.0.1", port.getHost().port, factory)
+    bot = yield factory.signed_on
+    operations = factory.backend.operations
+
+    def send(batch):
+        """Send a batch of messages to the bot."""
+        now = time.time()
+
+        for user, channel, text in batch:
+            factory.sent.setdefault((user, channel), deque()).append(now)
+            factory.server.sendLine(":{} PRIVMSG {} :{}".format(user,
+                channel, text))
+
+    start = time.time()
+
+    if options["rate"]:
+        per_tick = max(1, options["rate"] // 100)
+        batches = iter([corpus[i:i + per_tick]
+            for i in range(0, len(corpus), per_tick)])
+        sender = task.LoopingCall(lambda: send(next(batches)))
+        sender.start(float(per_tick) / options["rate"]).addErrback(
+            lambda failure: failure.trap(StopIteration))
+    else:
+        send(corpus)
+
+    end = yield factory.done
+    elapsed = end - start
+    result = {
+        "channels": len(channels),
+        "words": options["words"],
+        "hits": options["hits"],
+        "messages": len(corpus),
+        "seconds": elapsed,
+        "msgs_per_sec": len(corpus) / elapsed if elapsed else None,
+        "p50_ms": percentile(factory.latencies, 0.50) * 1000,
+        "p99_ms": percentile(factory.latencies, 0.99) * 1000,
+        "db_ops_per_msg": float(factory.backend.operations - operations) /
+            len(corpus),
+        "queue": bot.queue.stats()
+        }
+
+    factory.stopTrying()
+    bot.transport.loseConnection()
+    yield port.stopListening()
+    defer.returnValue(result)
+
+
+def compare(result, baseline, tolerance):
+    """Return a list of regressions compared to a baseline."""
+    regressions = []
+
+    if result["msgs_per_sec"] < baseline["msgs_per_sec"] * (1 - tolerance):
+        regressions.append("msgs_per_sec {:.0f} < {:.0f}".format(
+            result["msgs_per_sec"], baseline["msgs_per_sec"]))
+
+    if result["p99_ms"] > baseline["p99_ms"] * (1 + tolerance):
+        regressions.append("p99_ms {:.2f} > {:.2f}".format(
+            result["p99_ms"], baseline["p99_ms"]))
+
+    return regressions
+
+
+def main():
+    """Parse options, run and report."""
+    options = Options()
+    options.parseOptions()
+
+    if mongomock is None:
+        sys.exit("The benchmark needs mongomock: pip install mongomock")
+
+    status = []
+
+    def report(result):
+        """Print and store the result."""
+        text = json.dumps(result, indent=2, sort_keys=True)
+        print(text)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(text + "\n")
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                regressions = compare(result, json.load(f),
+                    options["tolerance"])
+
+            for regression in regressions:
+                sys.stderr.write("Regression: {}\n".format(regression))
+
+            status.append(1 if regressions else 0)
+
+    def failed(failure):
+        """Print the error."""
+        failure.printTraceback()
+        status.append(2)
+
+    def start():
+        """Run once the reactor runs, so a failure can stop it."""
+        d = run(options)
+        d.addCallbacks(report, failed)
+        d.addBoth(lambda result: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+    sys.exit(status[0] if status else 0)
+
+
+if __name__ == "__main__":
+    main()
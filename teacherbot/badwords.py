@@ -1,41 +1,282 @@
 # -*- coding: utf-8 -*-
 
-import pymongo
-import re
+import hashlib
+from twisted.internet import defer, threads
+from twisted.python import log
+from matcher import Matchers, PatternError, REGEX, classify
+import metrics
+import wordlist
+from verdicts import VerdictCache
+
+
+def _text(word):
+    """Return word as text the same way it is read back from database."""
+    if isinstance(word, bytes):
+        return word.decode('utf8')
+
+    return word
 
 
 class Badwords(object):
-    """An engine to check text for badwords."""
+    """An engine to check text for badwords.
+
+    The word lists are kept in memory together with compiled matchers, so
+    checking a message needs no database round trip. Matching runs either in
+    the reactor thread pool or, when processes is set, in a pool of worker
+    processes that the channels are sharded across.
 
-    def __init__(self, db):
+    Words are classified when they are added, and invalid regexes or ones
+    that could backtrack exponentially are refused. Words already stored
+    that don't pass are listed but not matched. Matching a message may take
+    at most budget seconds, see Matchers and ProcessPool. A thread can't be
+    stopped in the middle of a match, so without processes but with a
+    budget the channels that have regex words are matched in a single
+    worker process instead, which is killed when it runs over.
+
+    Verdicts are cached by a hash of the word list of the channel and the
+    message, so repeated spam is answered without matching, also in other
+    channels with the same list. Channels demoted to literal words for
+    running over the budget are cached apart, and verdicts of messages that
+    could not be checked are not cached at all.
+    """
+
+    def __init__(self, db, processes=0, budget=None, cache_size=10000,
+        cache_ttl=60):
         """Init"""
-        self._coll = db.badwords
-        self._coll.ensure_index([("word", pymongo.ASCENDING),
-            ("channel", pymongo.ASCENDING)])
+        self._db = db
+        self._words = {}
+        self._contents = {}
+        self._demoted = set()
+        self._pool = None
+        self._budget = budget
+        self._killable = None
+        self._routed = set()
+        self.cache = VerdictCache(cache_size, cache_ttl)
+
+        if processes:
+            from procpool import ProcessPool
+            self._pool = self._matchers = ProcessPool(processes, budget,
+                self._report)
+        else:
+            self._matchers = Matchers(budget)
+
+    def load(self):
+        """Load the words of all channels from database."""
+        return self._db.badwords().addCallback(self._loaded)
+
+    def reload(self, channel):
+        """Load the words of one channel from database again."""
+
+        def loaded(rows):
+            """Called with the badword documents of the channel."""
+            self._words[channel] = [row['word'] for row in rows]
+            self._set_words(channel)
+
+        return self._db.badwords(channel).addCallback(loaded)
+
+    def _loaded(self, rows):
+        """Called with all the badword documents."""
+        words = {}
+
+        for row in rows:
+            words.setdefault(row['channel'], []).append(row['word'])
+
+        self._words = words
+        self._matchers.clear()
+        self._routed = set()
+        self._demoted = set()
+
+        if self._killable is not None:
+            self._killable.clear()
+        self.cache.clear()
+
+        for channel in words:
+            self._set_words(channel)
+
+    def _set_words(self, channel):
+        """Pass the usable words of a channel on to the matchers."""
+        words = []
+        regex = False
+
+        for word in self._words.get(channel, ()):
+            try:
+                kind = classify(word)
+            except PatternError as exc:
+                log.msg(u"Not matching badword {!r} in {}: {}".format(word,
+                    channel, exc))
+            else:
+                words.append(word)
+                regex = regex or kind == REGEX
+
+        self._contents[channel] = hashlib.sha1(u"\n".join(words).encode(
+            'utf8')).digest()
+        self._demoted.discard(channel)
+
+        if self._pool is None and self._budget is not None and regex:
+            self._killable_pool().set_words(channel, words)
+            self._matchers.set_words(channel, [])
+            self._routed.add(channel)
+        else:
+            if channel in self._routed:
+                self._killable.set_words(channel, [])
+                self._routed.discard(channel)
+
+            self._matchers.set_words(channel, words)
+
+    def _killable_pool(self):
+        """Return the worker process for regex channels, starting it."""
+        if self._killable is None:
+            from procpool import ProcessPool
+            self._killable = ProcessPool(1, self._budget, self._report)
+
+        return self._killable
+
+    def _report(self, overruns):
+        """Log matches that went over the budget."""
+        for channel, seconds in overruns:
+            self._demoted.add(channel)
+            metrics.SLOW_MATCHES.inc(channel=channel)
+            log.msg("Matching in {} took {:.3f}s, only literal words are "
+                "checked there until its words change".format(channel,
+                seconds))
 
     def add(self, word, channel):
-        """Add a word to database"""
-        self._coll.insert({"word": word.strip(), "channel": channel.strip()})
+        """Add a word to database.
+
+        Fails with PatternError if the word can't be used.
+        """
+        word, channel = _text(word).strip(), channel.strip()
+
+        try:
+            classify(word)
+        except PatternError:
+            return defer.fail()
+
+        def added(result):
+            """Update the cached list once the word is stored."""
+            self._words.setdefault(channel, []).append(word)
+            self._set_words(channel)
+
+        return self._db.add_badword(word, channel).addCallback(added)
+
+    def add_many(self, words, channel):
+        """Add many words to a channel with one write and one rebuild.
+
+        Returns a Deferred firing with the list of added words and a list of
+        (word, reason) for the refused ones. Words the channel already has
+        are neither.
+        """
+        channel = channel.strip()
+        words, refused = wordlist.admit(_text(word).strip() for word in words)
+
+        def added(new):
+            """Update the cached list once the words are stored."""
+            self._words.setdefault(channel, []).extend(new)
+            self._set_words(channel)
+            return new, refused
+
+        return self._db.add_badwords(words, channel).addCallback(added)
+
+    def copy(self, source, channel):
+        """Add the words of one channel to another, see add_many."""
+        return self.add_many(self.show(source.strip()), channel)
 
     def delete(self, word, channel):
         """Delete a word from the database"""
-        self._coll.remove({"word": word.strip(), "channel": channel.strip()})
+        word, channel = _text(word).strip(), channel.strip()
+
+        def deleted(result):
+            """Update the cached list once the word is removed."""
+            self._words[channel] = [w for w in self._words.get(channel, ())
+                if w != word]
+            self._set_words(channel)
+
+        return self._db.delete_badword(word, channel).addCallback(deleted)
+
+    def check_many(self, items):
+        """Check a list of (channel, msg, literal_only).
+
+        Returns a Deferred firing with a list of verdicts in the same order.
+        Only messages without a cached verdict are matched, and each of them
+        only once per batch.
+        """
+        verdicts = [None] * len(items)
+        misses = []
+        pending = {}
+
+        for position, (channel, msg, literal_only) in enumerate(items):
+            key = (self._contents.get(channel), literal_only or channel in
+                self._demoted, msg)
+            verdict = self.cache.get(key)
+
+            if verdict is not None:
+                verdicts[position] = verdict
+            elif key in pending:
+                pending[key].append(position)
+            else:
+                pending[key] = [position]
+                misses.append((key, (channel, msg, literal_only)))
+
+        if not misses:
+            return defer.succeed(verdicts)
+
+        def fill(results):
+            """Cache the new verdicts and put them in place."""
+            for (key, item), verdict in zip(misses, results):
+                if verdict is not None:
+                    self.cache.put(key, verdict)
+
+                for position in pending[key]:
+                    verdicts[position] = verdict
+
+            return verdicts
+
+        return self._check_many([item for key, item in misses]).addCallback(
+            fill)
+
+    def _check_many(self, items):
+        """Match a list of (channel, msg, literal_only)."""
+        if self._pool is not None:
+            return self._pool.check_many(items)
+
+        routed = [position for position, item in enumerate(items)
+            if item[0] in self._routed]
+
+        if not routed:
+            return threads.deferToThread(self._matchers.check_many,
+                items).addCallback(self._checked)
+
+        verdicts = [None] * len(items)
+        local = [position for position, item in enumerate(items)
+            if item[0] not in self._routed]
+
+        def fill(results, positions):
+            """Put the verdicts of a part of the batch in place."""
+            for position, verdict in zip(positions, results):
+                verdicts[position] = verdict
+
+        checks = [self._killable.check_many([items[position]
+            for position in routed]).addCallback(fill, routed)]
 
-    def check(self, channel, msg):
-        """Check if any word is found."""
-        found = False
-        cursor = self._coll.find({"channel": channel})
+        if local:
+            checks.append(threads.deferToThread(self._matchers.check_many,
+                [items[position] for position in local]).addCallback(
+                self._checked).addCallback(fill, local))
 
-        for row in cursor:
-            if re.search(row['word'].encode('utf8'), msg, re.I | re.U):
-                found = True
-                break
+        return defer.gatherResults(checks).addCallback(lambda result:
+            verdicts)
 
-        return found
+    def _checked(self, verdicts):
+        """Report the overruns of a batch checked in a thread."""
+        self._report(self._matchers.take_overruns())
+        return verdicts
 
     def show(self, channel):
         """List all the words"""
-        words = list(self._coll.find({"channel": channel},
-            {"_id": False, "channel": False}))
+        return list(self._words.get(channel, ()))
 
-        return words
\ No newline at end of file
+    def stop(self):
+        """Stop the worker processes, if any."""
+        for pool in (self._pool, self._killable):
+            if pool is not None:
+                pool.stop()
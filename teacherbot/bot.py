@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
 from twisted.words.protocols import irc
-from twisted.internet import threads
+from twisted.internet import defer, threads
 from twisted.python import log
-from pymongo.errors import DuplicateKeyError
-from badwords import Badwords
+from matcher import PatternError
+from checkqueue import CheckQueue
+from outbound import Scheduler, CONTROL, MODERATION, WARNING, REPLY
+from outbound import MAX_LINE, PREFIX_RESERVE, join_lines, pack
+import metrics
+from database import DuplicateError
+from settings import ChannelSettings, encode
+from core import network_configs
+from changes import BADWORDS, CHAN_SETTINGS, IGNORE, USER
+import wordlist
 
 
 # Decorator to check so the user has permission to use the function.
@@ -16,18 +27,27 @@ def has_permission(role, channel=None):
         """Decorator function"""
 
         @wraps(func)
+        @defer.inlineCallbacks
         def wrapped_func(self, user, src_chan, *args, **kwargs):
             """Wrapped function"""
-            coll = self.factory.db.users
+            hostmask = user.split('!', 1)[1]
 
-            user_doc = coll.find_one({"hostmask": user.split('!', 1)[1]})
+            try:
+                session = self.factory.sessions.get(hostmask,
+                    self.factory.name)
+            except KeyError:
+                user_doc = yield self.factory.db.user_by_hostmask(hostmask,
+                    self.factory.name)
+                session = self.factory.sessions.set(hostmask, user_doc,
+                    self.factory.name)
 
-            if user_doc is not None and user_doc['role'][role]:
+            allowed = False
+
+            if session is not None and session.role[role]:
                 if channel is not None:
                     if len(args) > channel:
-                        if args[channel] in user_doc['channels'] \
-                            or user_doc["all"]:
-                            func(self, user, src_chan, *args, **kwargs)
+                        if args[channel] in session.channels or session.all:
+                            allowed = True
                         else:
                             self.notice(user.split('!', 1)[0],
                                 "Permission denied!")
@@ -35,10 +55,23 @@ def has_permission(role, channel=None):
                         self.notice(user.split('!', 1)[0],
                                 "No channel given.")
                 else:
-                    func(self, user, src_chan, *args, **kwargs)
+                    allowed = True
             else:
                 self.notice(user.split('!', 1)[0], "Perrmission denied!")
 
+            # Only the command and its channel, the arguments may hold
+            # passwords.
+            self.factory.events.record("command", network=self.factory.name,
+                command=func.__name__[4:], channel=src_chan,
+                target=args[channel] if channel is not None and
+                    len(args) > channel else None,
+                nick=user.split('!', 1)[0], hostmask=hostmask,
+                username=session.username if session is not None else None,
+                allowed=allowed)
+
+            if allowed:
+                yield func(self, user, src_chan, *args, **kwargs)
+
         return wrapped_func
     return permission_decorator
 
@@ -51,6 +84,13 @@ class Bot(irc.IRCClient):
     username = ""
     realname = ""
     engine = None
+    queue = None
+    ready = None
+    scheduler = None
+    _outbound = (CONTROL, None, None)
+    _keyed = None
+    _connected = None
+    _joining = ()
 
     def connectionMade(self):
         """Is run when the connection is successful."""
@@ -58,7 +98,27 @@ class Bot(irc.IRCClient):
         self.password = self.factory.password
         self.username = self.factory.username
         self.realname = self.factory.realname
-        self.lineRate = self.factory.linerate
+        self.engine = self.factory.engine
+        self._connected = time.time()
+        self._motd = defer.Deferred()
+        general = self.factory.config['general']
+        # Lines are paced by the scheduler instead of IRCClient's lineRate.
+        self.lineRate = None
+        self.scheduler = Scheduler(self._reallySendLine,
+            1.0 / self.factory.linerate if self.factory.linerate else None,
+            general.get('burst', 4))
+        self.queue = CheckQueue(self.check, self.badword,
+            general.get('queue_depth', 1000),
+            general.get('queue_policy', 'drop'),
+            general.get('queue_sample', 10),
+            general.get('queue_workers', 4),
+            general.get('batch_window', 0.01),
+            general.get('batch_size', 100))
+        metrics.CONNECTIONS.inc(event="made", network=self.factory.name)
+        metrics.QUEUE_DEPTH.set_function(lambda: self.queue.depth,
+            network=self.factory.name)
+        metrics.OUTBOUND_QUEUE.set_function(lambda: len(self.scheduler),
+            network=self.factory.name)
 
         irc.IRCClient.connectionMade(self)
 
@@ -66,11 +126,139 @@ class Bot(irc.IRCClient):
         """Is run if the connection is lost."""
         irc.IRCClient.connectionLost(self, reason)
         log.err(reason)
+        metrics.CONNECTIONS.inc(event="lost", network=self.factory.name)
+        self.scheduler.clear()
+
+    def sendLine(self, line):
+        """Queue a line in the outbound scheduler."""
+        if self._keyed is not None:
+            self._keyed.append(line)
+        else:
+            self.scheduler.put(line, *self._outbound)
+
+    @contextmanager
+    def outbound(self, priority, target=None, key=None):
+        """Send the lines written in this block with a priority.
+
+        A message with a key replaces a queued message with the same key.
+        Only a single line can be replaced, so when the message is split
+        into several lines they are all queued without the key.
+        """
+        previous, self._outbound = self._outbound, (priority, target, key)
+        keyed, self._keyed = self._keyed, [] if key is not None else None
+
+        try:
+            yield
+        finally:
+            lines, self._keyed = self._keyed, keyed
+            self._outbound = previous
+
+            for line in lines or ():
+                self.scheduler.put(line, priority, target,
+                    key if len(lines) == 1 else None)
+
+    def msg(self, user, message, length=None):
+        """Send a message, as a command reply unless told otherwise."""
+        if self._outbound[0] == CONTROL:
+            with self.outbound(REPLY, user):
+                irc.IRCClient.msg(self, user, message, length)
+        else:
+            irc.IRCClient.msg(self, user, message, length)
+
+    def notice(self, user, message):
+        """Send a notice, as a command reply unless told otherwise."""
+        if self._outbound[0] == CONTROL:
+            with self.outbound(REPLY, user):
+                irc.IRCClient.notice(self, user, message)
+        else:
+            irc.IRCClient.notice(self, user, message)
+
+    def notice_lines(self, user, items, page=1, separator=", ", header=None,
+        more=None, **fields):
+        """Send items packed into as few notices as fit, one page at a time.
+
+        header is sent first and gets the page number and page count
+        formatted into it. more gets the number of the next page and is sent
+        last when there are more pages. Both also get fields formatted into
+        them, so text from users never becomes part of a format string.
+        """
+        width = MAX_LINE - PREFIX_RESERVE - len("NOTICE %s :\r\n" % user)
+        lines = pack(items, width, separator)
+        size = self.factory.config['general'].get('page_lines', 5)
+        pages = max(1, (len(lines) + size - 1) // size)
+        page = min(max(page, 1), pages)
+
+        if header is not None:
+            self.notice(user, header.format(page=page, pages=pages, **fields))
+
+        for line in lines[(page - 1) * size:page * size]:
+            self.notice(user, line)
+
+        if more is not None and page < pages:
+            self.notice(user, more.format(page=page + 1, **fields))
 
     # callbacks for events
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
-        self.engine = Badwords(self.factory.db)
+        self.ready = self.factory.warm_start()
+
+        # The limits of the server are known once the MOTD is through.
+        defer.gatherResults([self.ready, self._motd]).addCallback(
+            lambda result: self.rejoin()).addErrback(log.err)
+
+    def receivedMOTD(self, motd):
+        """Called when the MOTD is received."""
+        if not self._motd.called:
+            self._motd.callback(None)
+
+    def irc_ERR_NOMOTD(self, prefix, params):
+        """Called when the server has no MOTD."""
+        self.receivedMOTD([])
+
+    def rejoin(self):
+        """Join all autojoin channels, as many per line as the server allows.
+
+        The lines are paced by the scheduler like any other line.
+        """
+        channels = [(encode(cs.channel), cs.key) for cs in
+            self.factory.chan_settings.values() if cs.autojoin and
+            (not cs.networks or self.factory.name in cs.networks)]
+        targets = (self.supported.getFeature("TARGMAX") or {}).get("JOIN")
+
+        try:
+            targets = int(targets or self.supported.getFeature("MAXTARGETS"))
+        except (TypeError, ValueError):
+            targets = None
+
+        self._joining = set(channel.lower() for channel, key in channels)
+
+        for line in join_lines(channels, targets):
+            self.sendLine(line)
+
+        log.msg("Joining {} channels.".format(len(channels)))
+
+    def _join_done(self, channel):
+        """Called when a channel is joined or could not be joined."""
+        if channel.lower() in self._joining:
+            self._joining.discard(channel.lower())
+
+            if not self._joining:
+                seconds = time.time() - self._connected
+                metrics.REJOIN_SECONDS.observe(seconds)
+                log.msg("All channels joined {:.3f}s after connecting.".format(
+                    seconds))
+
+    def _join_failed(self, prefix, params):
+        """Called when the server refuses to let me join a channel."""
+        log.msg("Could not join {}: {}".format(params[1], params[-1]))
+        self._join_done(params[1])
+
+    irc_ERR_NOSUCHCHANNEL = _join_failed
+    irc_ERR_TOOMANYCHANNELS = _join_failed
+    irc_ERR_CHANNELISFULL = _join_failed
+    irc_ERR_INVITEONLYCHAN = _join_failed
+    irc_ERR_BANNEDFROMCHAN = _join_failed
+    irc_ERR_BADCHANNELKEY = _join_failed
 
     def kickedFrom(self, channel, kicker, message):
         """Called when I am kicked from a channel."""
@@ -81,68 +269,84 @@ class Bot(irc.IRCClient):
     def joined(self, channel):
         """This will get called when the bot joins the channel."""
         log.msg("I joined {}".format(channel))
+        self._join_done(channel)
 
     def noticed(self, user, channel, msg):
         """Called when a notice is recieved."""
         log.msg("From %s/%s: %s" % (user, channel, msg))
 
+    def check(self, items):
+        """Check a batch of messages with the engine. Returns a Deferred."""
+        return self.engine.check_many(items)
+
     # A callback that gets a result after checking a word and kicks a user by
     # sending a command to ChanServ with a reason.
     def badword(self, result, user, channel):
         """Is called when a search of the text engine is done."""
         if result:
-            kicklist = self.factory.db.kicklist
-            record = kicklist.find_one({"hostmask": user.split('!', 1)[1]})
-            cs = self.factory.db.chan_settings.find_one({"channel": channel})
-
-            if record is None:
-                record = {
-                    "nickname": user.split('!', 1)[0],
-                    "hostmask": user.split('!', 1)[1],
-                    "warns": 0,
-                    "kicks": 0,
-                    "channel": channel
-                    }
-
-                kicklist.save(record)
-
-            record = kicklist.find_one({"hostmask": user.split('!', 1)[1]})
-
-            if cs['ban'] and record["kicks"] >= cs['ttb'] and \
-                record["warns"] >= cs['ttk']:
-                self.msg(cs['chanserv'].encode('utf8'),
-                    cs['cmd_atb'].encode('utf8').format(
-                        channel=channel,
-                        user=user.split('!', 1)[0],
-                        bantime=cs['bantime'],
-                        reason=cs['ban_reason'].encode('utf8').format(
-                            bantime=cs['bantime'])
-                        ))
-                record['kicks'] = 0
-                record['warns'] = 0
-            elif cs['kicker'] and record["warns"] >= cs['ttk']:
-                self.msg(cs['chanserv'].encode('utf8'),
-                    cs['cmd_kick'].encode('utf8').format(
-                        channel=channel,
-                        user=user.split('!', 1)[0],
-                        reason=cs['kick_reason'].encode('utf8')
-                        ))
-                record['warns'] = 0
-                record['kicks'] += 1
+            self.escalate(user, channel, "warning", "badword", result)
+
+    def escalate(self, user, channel, warning, reason, word=None):
+        """Warn, kick or ban a user for an offence in a channel.
+
+        warning is the setting with the text to warn with. reason and the
+        word that was found, if any, go to the event log.
+        """
+        cs = self.factory.chan_settings.get(channel)
+
+        if cs is not None:
+            start = time.time()
+            hostmask = user.split('!', 1)[1]
+            kicklist = self.factory.kicklist
+            record = kicklist.get(hostmask, user.split('!', 1)[0], channel)
+            # The counters the decision was made on, for the event log.
+            warns, kicks = record.warns, record.kicks
+
+            if cs.ban and record.kicks >= cs.ttb and record.warns >= cs.ttk:
+                with self.outbound(MODERATION, cs.chanserv):
+                    self.msg(cs.chanserv,
+                        cs.cmd_atb.format(
+                            channel=channel,
+                            user=user.split('!', 1)[0],
+                            bantime=cs.bantime,
+                            reason=cs.ban_reason.format(bantime=cs.bantime)
+                            ))
+                kicklist.reset(hostmask)
+                action = "ban"
+            elif cs.kicker and record.warns >= cs.ttk:
+                with self.outbound(MODERATION, cs.chanserv):
+                    self.msg(cs.chanserv,
+                        cs.cmd_kick.format(
+                            channel=channel,
+                            user=user.split('!', 1)[0],
+                            reason=cs.kick_reason
+                            ))
+                kicklist.kick(hostmask)
+                action = "kick"
             else:
-                if cs['private']:
-                    self.notice(user.split('!', 1)[0],
-                        cs['warning'].encode('utf8'))
-                else:
-                    self.msg(channel, cs['warning'].encode('utf8').format(
-                        user=user.split('!', 1)[0]))
+                # Only the latest warning to a user in a channel matters.
+                with self.outbound(WARNING, channel,
+                    ("warning", channel, hostmask)):
+                    if cs.private:
+                        self.notice(user.split('!', 1)[0],
+                            getattr(cs, warning))
+                    else:
+                        self.msg(channel, getattr(cs, warning).format(
+                            user=user.split('!', 1)[0]))
 
-                record['warns'] += 1
+                kicklist.warn(hostmask)
+                action = "warn"
 
-            kicklist.save(record)
+            metrics.ACTIONS.inc(action=action)
+            self.factory.events.record(action, network=self.factory.name,
+                channel=channel, nick=user.split('!', 1)[0],
+                hostmask=hostmask, reason=reason, word=word,
+                warns=warns, kicks=kicks)
+            metrics.BADWORD_SECONDS.observe(time.time() - start)
 
     def privmsg(self, user, channel, msg):
         """This will get called when the bot receives a message."""
+        start = time.time()
 
         if msg.startswith("@"):
             cmd = msg.split()[0].strip("@")
@@ -151,81 +355,116 @@ class Bot(irc.IRCClient):
             func = getattr(self, 'cmd_' + cmd, None)
 
             if func is not None:
-                threads.deferToThread(func, user,
-                    channel, *args)
+                metrics.COMMAND_SECONDS.time(defer.maybeDeferred(func, user,
+                    channel, *args), command=cmd).addErrback(log.err)
             else:
                 self.notice(user.split('!', 1)[0], "Unknown command!")
         else:
             if channel != self.nickname:
-                coll = self.factory.db.ignore
+                hostmask = user.split('!', 1)[1]
+
+                if hostmask not in self.factory.ignored:
+                    cs = self.factory.chan_settings.get(channel)
+
+                    if cs is not None:
+                        flood = self.factory.floods.check(channel, hostmask,
+                            msg, cs)
+
+                        if flood is not None:
+                            metrics.FLOODS.inc(kind=flood)
+                            self.escalate(user, channel, "flood_warning",
+                                flood)
 
-                hostmask = coll.find_one({"hostmask": user.split('!', 1)[1]})
+                    # Matching runs in threads from a bounded queue so a
+                    # flood can't build up an unbounded backlog.
+                    self.queue.put(user, channel, msg)
 
-                if hostmask is None:
-                    # Run defer in thread so it doesn't block if many results
-                    # in db.
-                    d = threads.deferToThread(self.engine.check, channel, msg)
-                    d.addCallback(self.badword, user, channel)
+        metrics.PRIVMSG_SECONDS.observe(time.time() - start)
 
     def userQuit(self, user, quitMessage):
         """Called when a user leaves the network"""
-        coll = self.factory.db.users
-        user_doc = coll.find_one({"nick": user})
+        split = self.factory.logins.quit(quitMessage)
 
-        if user_doc is not None:
-            user_doc['hostmask'] = ""
-            user_doc['nick'] = ""
-            coll.save(user_doc)
-            log.msg("User {} was automaticlly logged off.".format(user))
+        username = self.factory.sessions.drop_nick(self.factory.name, user)
+
+        if username is not None:
+            self.factory.logins.logoff(username)
+
+            if not split:
+                log.msg("User {} was automaticlly logged off.".format(user))
 
     def userRenamed(self, oldname, newname):
         """Called when a user changes nick"""
-        coll = self.factory.db.users
-        user_doc = coll.find_one({"nick": oldname})
+        username = self.factory.sessions.rename(self.factory.name, oldname,
+            newname)
 
-        if user_doc is not None:
-            user_doc['nick'] = newname
-            coll.save(user_doc)
+        if username is not None:
+            self.factory.logins.rename(username, newname)
             log.msg("User {} changed nick to {}".format(oldname, newname))
 
     # User-defined commands
     @has_permission("admin", 0)
+    @defer.inlineCallbacks
     def cmd_join(self, user, src_chan, channel, password=None):
         """Join a channel. @join <channel> [<password>]"""
         if channel:
-            coll = self.factory.db.chan_settings
-            cs = coll.find_one({"channel": channel})
-
-            if cs is None:
-                cs = {
-                    "channel": channel,
-                    "ttb": 3,
-                    "ttk": 3,
-                    "kicker": False,
-                    "ban": False,
-                    "private": True,
-                    "bantime": 60,
-                    "cmd_atb": "",
-                    "cmd_kick": "",
-                    "chanserv": "ChanServ",
-                    "kick_reason": "Watch your language!",
-                    "ban_reason": "Watch your language!",
-                    "warning": "Watch your language!"
-                    }
-
-                coll.save(cs)
+            if channel not in self.factory.chan_settings:
+                cs = yield self.factory.db.chan_settings_for(channel)
+
+                if cs is None:
+                    cs = ChannelSettings(channel)
+                    yield self.factory.db.save_chan_settings(cs.to_doc())
+                else:
+                    cs = ChannelSettings.from_doc(cs)
+
+                self.factory.chan_settings[channel] = cs
 
+            yield self._autojoin(channel, True)
+            yield self.factory.db.set_chan_setting(channel, "key",
+                password or "")
+            self.factory.chan_settings[channel].set("key", password or "")
+            self.factory.publish(CHAN_SETTINGS, channel)
             self.join(channel, password)
 
     @has_permission("admin", 0)
+    @defer.inlineCallbacks
     def cmd_part(self, user, src_chan, channel, password=None):
         """Leave a channel. @part <channel>"""
         if channel:
+            if channel in self.factory.chan_settings:
+                yield self._autojoin(channel, False)
+                self.factory.publish(CHAN_SETTINGS, channel)
+
             self.part(channel)
 
+    @defer.inlineCallbacks
+    def _autojoin(self, channel, join):
+        """Add or remove this network from the autojoin of a channel."""
+        cs = self.factory.chan_settings[channel]
+
+        if cs.autojoin and not cs.networks:
+            networks = set(network["name"] for network in
+                network_configs(self.factory.config))
+        else:
+            networks = set(cs.get("networks") if cs.autojoin else ())
+
+        if join:
+            networks.add(self.factory.name)
+        else:
+            networks.discard(self.factory.name)
+
+        networks = sorted(networks)
+        yield self.factory.db.set_chan_setting(channel, "networks", networks)
+        yield self.factory.db.set_chan_setting(channel, "autojoin",
+            bool(networks))
+        cs.set("networks", networks)
+        cs.set("autojoin", bool(networks))
+
     @has_permission("owner")
     def cmd_quit(self, user, src_chan, *args):
         """Shutdown the bot."""
+        self.factory.quitting = True
+        self.factory.stopTrying()
         self.quit(message="Shutting down.")
 
     @has_permission("admin")
@@ -234,24 +473,29 @@ class Bot(irc.IRCClient):
         if dest and message:
             self.msg(dest, ' '.join(message))
 
+    @defer.inlineCallbacks
     def cmd_auth(self, user, src_chan, username, password):
         """Authenticate with the bot. @auth <username> <password>"""
         m = hashlib.sha512()
         m.update(password)
         password = m.hexdigest()
 
-        coll = self.factory.db.users
-        user_doc = coll.find_one({"username": username, "password": password})
+        user_doc = yield self.factory.db.user_by_login(username, password)
 
         if user_doc:
             self.notice(user.split('!', 1)[0], "I recognize you.")
 
             user_doc["hostmask"] = user.split('!', 1)[1]
             user_doc["nick"] = user.split('!', 1)[0]
-            coll.save(user_doc)
+            user_doc["network"] = self.factory.name
+            # A queued logoff of this user must not undo the new login.
+            yield self.factory.logins.flush()
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
         else:
             self.notice(user.split('!', 1)[0], "I don't know you.")
 
+    @defer.inlineCallbacks
     def cmd_register(self, user, src_chan, username, password):
         """Register your nickname to the bot. @register <username> <password>"""
         m = hashlib.sha512()
@@ -263,22 +507,23 @@ class Bot(irc.IRCClient):
             "hostmask": user.split('!', 1)[1],
             "role": {"user": True, "admin": False, "op": False, "owner": False},
             "nick": user.split('!', 1)[0],
+            "network": self.factory.name,
             "channels": {},
             "all": False
             }
 
-        coll = self.factory.db.users
-
         try:
-            coll.insert(user_doc)
-        except DuplicateKeyError:
+            yield self.factory.db.insert_user(user_doc)
+        except DuplicateError:
             self.notice(user.split('!', 1)[0],
                 "Username already in use.")
         else:
+            self.factory.sessions.update(user_doc)
             self.notice(user.split('!', 1)[0],
                 "Your username is now registered.")
 
     @has_permission("user")
+    @defer.inlineCallbacks
     def cmd_remove(self, user, src_chan, username, password):
         """Unregister your nickname from the bot. @remove """
         """<username> <password>"""
@@ -286,11 +531,12 @@ class Bot(irc.IRCClient):
         m.update(password)
         password = m.hexdigest()
 
-        coll = self.factory.db.users
-        user_doc = coll.find_one({"username": username, "password": password})
+        user_doc = yield self.factory.db.user_by_login(username, password)
 
         if user_doc is not None:
-            coll.remove(user_doc["_id"])
+            yield self.factory.db.remove_user(user_doc["_id"])
+            self.factory.sessions.drop_username(username)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0],
                 "Your nickname has been removed.")
         else:
@@ -298,11 +544,10 @@ class Bot(irc.IRCClient):
                 "Your nickname could not be removed!")
 
     @has_permission("admin", 1)
+    @defer.inlineCallbacks
     def cmd_op(self, user, src_chan, username, channel):
         """Escalate privileges to operator level for a user. @op <username>"""
-        coll = self.factory.db.users
-
-        user_doc = coll.find_one({"username": username})
+        user_doc = yield self.factory.db.user_by_name(username)
 
         if user_doc is not None:
             user_doc['role']['user'] = True
@@ -310,17 +555,18 @@ class Bot(irc.IRCClient):
             user_doc['role']['admin'] = False
             user_doc['role']['owner'] = False
             user_doc['channels'][channel] = None
-            coll.save(user_doc)
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0], "User have now been opped!")
         else:
             self.notice(user.split('!', 1)[0], "User not registered!")
 
     @has_permission("admin", 1)
+    @defer.inlineCallbacks
     def cmd_deop(self, user, src_chan, username, channel):
         """Remove operator privilege from a user. @deop <username> <channel>"""
-        coll = self.factory.db.users
-
-        user_doc = coll.find_one({"username": username})
+        user_doc = yield self.factory.db.user_by_name(username)
 
         if user_doc is not None:
             user_doc['role']['user'] = True
@@ -328,17 +574,18 @@ class Bot(irc.IRCClient):
             user_doc['role']['admin'] = False
             user_doc['role']['owner'] = False
             del user_doc['channels'][channel]
-            coll.save(user_doc)
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0], "User have now been deopped!")
         else:
             self.notice(user.split('!', 1)[0], "User not registered!")
 
     @has_permission("owner", 1)
+    @defer.inlineCallbacks
     def cmd_admin(self, user, src_chan, username, channel):
         """Escalate privileges to admin level for a user. @admin <username>"""
-        coll = self.factory.db.users
-
-        user_doc = coll.find_one({"username": username})
+        user_doc = yield self.factory.db.user_by_name(username)
 
         if user_doc is not None:
             user_doc['role']['user'] = True
@@ -346,17 +593,18 @@ class Bot(irc.IRCClient):
             user_doc['role']['admin'] = True
             user_doc['role']['owner'] = False
             user_doc['channels'][channel] = None
-            coll.save(user_doc)
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0], "User have now been admined!")
         else:
             self.notice(user.split('!', 1)[0], "User not registered!")
 
     @has_permission("owner", 1)
+    @defer.inlineCallbacks
     def cmd_deadmin(self, user, src_chan, username, channel):
         """Remove admin privilege from a user. @deadmin <username> <channel>"""
-        coll = self.factory.db.users
-
-        user_doc = coll.find_one({"username": username})
+        user_doc = yield self.factory.db.user_by_name(username)
 
         if user_doc is not None:
             user_doc['role']['user'] = True
@@ -364,17 +612,18 @@ class Bot(irc.IRCClient):
             user_doc['role']['admin'] = False
             user_doc['role']['owner'] = False
             del user_doc['channels'][channel]
-            coll.save(user_doc)
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0], "User have now been deadmined!")
         else:
             self.notice(user.split('!', 1)[0], "User not registered!")
 
     @has_permission("owner")
+    @defer.inlineCallbacks
     def cmd_owner(self, user, src_chan, username):
         """Give owner privilege to a user. @owner <username>"""
-        coll = self.factory.db.users
-
-        user_doc = coll.find_one({"username": username})
+        user_doc = yield self.factory.db.user_by_name(username)
 
         if user_doc is not None:
             user_doc['role']['owner'] = True
@@ -382,120 +631,212 @@ class Bot(irc.IRCClient):
             user_doc['role']['op'] = True
             user_doc['role']['user'] = True
             user_doc["all"] = True
-            coll.save(user_doc)
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0], "User now has all privileges.")
         else:
             self.notice(user.split('!', 1)[0], "User not registered!")
 
     @has_permission("op", 1)
+    @defer.inlineCallbacks
     def cmd_addword(self, user, src_chan, word, channel):
         """Blacklist a word by regexp. @addword <word> <channel>"""
 
         try:
-            self.engine.add(word, channel)
+            yield self.engine.add(word, channel)
+        except PatternError as exc:
+            self.notice(user.split('!', 1)[0], "Refused word %s: %s" % (
+                word, exc))
         except Exception as exc:
             log.err(exc)
             self.notice(user.split('!', 1)[0], "An error ocurred")
         else:
+            self.factory.publish(BADWORDS, channel)
             self.notice(user.split('!', 1)[0], "Added word %s" % word)
 
     @has_permission("op", 1)
+    @defer.inlineCallbacks
     def cmd_delword(self, user, src_chan, word, channel):
         """Delete a word from a blacklist. @delword <word> <channel>"""
 
         try:
-            self.engine.delete(word, channel)
+            yield self.engine.delete(word, channel)
         except Exception as exc:
             log.err(exc)
             self.notice(user.split('!', 1)[0], "An error ocurred")
         else:
+            self.factory.publish(BADWORDS, channel)
             self.notice(user.split('!', 1)[0], "Deleted word %s" % word)
 
+    def _words_added(self, nick, channel, words, added, refused):
+        """Tell how a bulk add of words went."""
+        self.notice(nick, "Added %d words to %s, %d were already there." % (
+            len(added), channel, len(words) - len(added) - len(refused)))
+
+        if refused:
+            self.notice_lines(nick, ["%s (%s)" % (word.encode("utf8"),
+                reason) for word, reason in refused], separator="; ",
+                header="Refused %d words:" % len(refused))
+
+    @has_permission("owner")
+    @defer.inlineCallbacks
+    def cmd_importwords(self, user, src_chan, path, channel):
+        """Import a blacklist from a file. @importwords <file> <channel>"""
+        nick = user.split('!', 1)[0]
+
+        try:
+            path = self.words_path(path)
+        except ValueError:
+            self.notice(nick, "Invalid file name! Give a name inside the "
+                "words directory.")
+            return
+
+        try:
+            words = yield threads.deferToThread(wordlist.read, path)
+            added, refused = yield self.engine.add_many(words, channel)
+        except Exception as exc:
+            log.err(exc)
+            self.notice(nick, "An error ocurred")
+        else:
+            self.factory.publish(BADWORDS, channel)
+            self._words_added(nick, channel, set(words), added, refused)
+
+    @has_permission("owner")
+    @defer.inlineCallbacks
+    def cmd_exportwords(self, user, src_chan, channel, path):
+        """Write a blacklist to a file. @exportwords <channel> <file>"""
+        nick = user.split('!', 1)[0]
+        words = self.engine.show(channel)
+
+        try:
+            name, path = path, self.words_path(path)
+        except ValueError:
+            self.notice(nick, "Invalid file name! Give a name inside the "
+                "words directory.")
+            return
+
+        try:
+            yield threads.deferToThread(wordlist.write, path, words)
+        except Exception as exc:
+            log.err(exc)
+            self.notice(nick, "An error ocurred")
+        else:
+            self.notice(nick, "Wrote %d words to %s." % (len(words), name))
+
+    def words_path(self, name):
+        """Return the path of a list file in the configured directory.
+
+        Raises ValueError if name is absolute or leads out of it.
+        """
+        return wordlist.resolve(self.factory.config['general'].get(
+            'words_dir', 'words'), name)
+
+    @has_permission("owner")
+    @defer.inlineCallbacks
+    def cmd_copywords(self, user, src_chan, source, channel):
+        """Copy a blacklist to another channel. @copywords <from> <to>"""
+        nick = user.split('!', 1)[0]
+        words = self.engine.show(source)
+
+        try:
+            added, refused = yield self.engine.copy(source, channel)
+        except Exception as exc:
+            log.err(exc)
+            self.notice(nick, "An error ocurred")
+        else:
+            self.factory.publish(BADWORDS, channel)
+            self._words_added(nick, channel, words, added, refused)
+
     @has_permission("op", 0)
-    def cmd_showwords(self, user, src_chan, channel):
-        """Show all blacklisted words for a channel. @showwords <channel>"""
+    def cmd_showwords(self, user, src_chan, channel, page="1"):
+        """Show the blacklist of a channel. @showwords <channel> [<page>]"""
 
         try:
             words = self.engine.show(channel)
+            page = int(page)
+        except ValueError:
+            self.notice(user.split('!', 1)[0],
+                "Invalid argument! Page must be an integer.")
         except Exception as exc:
             log.err(exc)
             self.notice(user.split('!', 1)[0], "An error ocurred")
         else:
             if len(words) > 0:
-                self.notice(user.split('!', 1)[0],
-                    "Blacklisted words for %s:" % channel)
-
-                for word in words:
-                    self.notice(user.split('!', 1)[0],
-                        word['word'].encode("utf8"))
+                self.notice_lines(user.split('!', 1)[0],
+                    [word.encode("utf8") for word in words], page,
+                    header="Blacklisted words for {channel} ({page}/{pages}):",
+                    more="More: @showwords {channel} {page}", channel=channel)
             else:
                 self.notice(user.split('!', 1)[0],
                     "No blacklisted words for %s." % channel)
 
     @has_permission("owner")
+    @defer.inlineCallbacks
     def cmd_allchan(self, user, src_chan, username):
         """Allow a user to change lists in all channels. @allchan <username>"""
 
-        coll = self.factory.db.users
-        user_doc = coll.find_one({"username": username})
+        user_doc = yield self.factory.db.user_by_name(username)
 
         if user_doc is not None:
             user_doc["all"] = True
-            coll.save(user_doc)
+            yield self.factory.db.save_user(user_doc)
+            self.factory.sessions.update(user_doc)
+            self.factory.publish(USER, username)
             self.notice(user.split('!', 1)[0], "Granted user all permission")
         else:
             self.notice(user.split('!', 1)[0], "User not registered!")
 
     @has_permission("admin", 1)
+    @defer.inlineCallbacks
     def cmd_set(self, user, src_chan, option, channel=None, *value):
         """Set an option for a channel. @set <option> <channel> <value>"""
 
         if channel is None:
             self.notice(user.split('!', 1)[0], "No channel specified!")
 
-        coll = self.factory.db.chan_settings
-        cs = coll.find_one({"channel": channel})
+        cs = self.factory.chan_settings.get(channel)
 
         if cs is not None:
             if option == "list":
                 self.notice(user.split('!', 1)[0], "Channel settings:")
 
-                for setting in cs:
-                    if setting == "_id":
-                        continue
-
+                for setting, current in cs.items():
                     self.notice(user.split('!', 1)[0], "{}: {}".format(setting,
-                        cs[setting]))
+                        current))
 
-            elif option in ("kicker", "ban", "private"):
+                return
+            elif option in ChannelSettings.BOOLEANS:
                 if value[0] == "on":
-                    cs[option] = True
+                    new = True
                 elif value[0] == "off":
-                    cs[option] = False
+                    new = False
                 else:
                     self.notice(user.split('!', 1)[0],
                         "Invalid argument! Must be 'on' or 'off'.")
                     return
-
-                coll.save(cs)
-            elif option in ("ttb", "bantime", "ttk"):
+            elif option in ChannelSettings.INTEGERS:
                 try:
-                    cs[option] = int(value[0])
-                except TypeError:
+                    new = int(value[0])
+                except ValueError:
                     self.notice(user.split('!', 1)[0],
                         "Invalid argument! Must be an integer.")
-                else:
-                    coll.save(cs)
+                    return
             elif option == "channel":
                 self.notice(user.split('!', 1)[0],
                         "Channel cannot be changed!")
                 return
-            elif option in ("cmd_atb", "cmd_kick", "ban_reason",
-                "kick_reason", "chanserv", "warning"):
-                cs[option] = ' '.join(value)
-                coll.save(cs)
+            elif option in ChannelSettings.STRINGS:
+                new = ' '.join(value)
             else:
                 self.notice(user.split('!', 1)[0], "Invalid option!")
+                return
+
+            # Write through so the cached settings never get ahead of the
+            # database.
+            yield self.factory.db.set_chan_setting(channel, option, new)
+            cs.set(option, new)
+            self.factory.publish(CHAN_SETTINGS, channel)
         else:
             self.notice(user.split('!', 1)[0],
                 "Channel does not exist in my records.")
@@ -509,32 +850,64 @@ class Bot(irc.IRCClient):
 
     @has_permission("user")
     def cmd_help(self, user, src_chan, cmd=None):
-        """Shows info about a command or lists commands. @help [<command>]"""
-
-        if cmd is None:
-            self.notice(user.split('!', 1)[0], "Commands:")
-
-            for func in dir(self):
-                if func.startswith("cmd_"):
-                    self.notice(user.split('!', 1)[0], "@" + func[4:] + " - " +
-                        getattr(self, func).__doc__)
+        """Show help for a command or list them. @help [<command>|<page>]"""
+
+        if cmd is None or cmd.isdigit():
+            self.notice_lines(user.split('!', 1)[0], self.help.values(),
+                int(cmd or 1), " | ", "Commands ({page}/{pages}):",
+                "More: @help {page}")
+        elif cmd in self.help:
+            self.notice(user.split('!', 1)[0], self.help[cmd])
         else:
-            func = getattr(self, "cmd_" + cmd)
-            self.notice(user.split('!', 1)[0], "@" + func.__name__[4:] +
-                 " - " + func.__doc__)
+            self.notice(user.split('!', 1)[0], "Unknown command!")
 
     @has_permission("admin")
+    @defer.inlineCallbacks
     def cmd_ignore(self, user, src_chan, hostmask):
         """Put a user in exception. @ignore <hostmask>"""
 
-        coll = self.factory.db.ignore
-        ignore_user = {"hostmask": hostmask}
-
         try:
-            coll.insert(ignore_user)
-        except DuplicateKeyError:
+            yield self.factory.db.add_ignore(hostmask)
+        except DuplicateError:
             self.notice(user.split('!', 1)[0],
                 "Already in list.")
         else:
+            self.factory.ignore(hostmask)
+            self.factory.publish(IGNORE, hostmask)
             self.notice(user.split('!', 1)[0],
                 "Added to list.")
+
+    @has_permission("admin")
+    @defer.inlineCallbacks
+    def cmd_reloadignore(self, user, src_chan, *args):
+        """Reload the ignore list from database. @reloadignore"""
+
+        try:
+            yield self.factory.load_ignore()
+        except Exception as exc:
+            log.err(exc)
+            self.notice(user.split('!', 1)[0], "An error ocurred")
+        else:
+            self.notice(user.split('!', 1)[0], "Ignore list reloaded with "
+                "%d entries." % len(self.factory.ignored))
+
+    @has_permission("admin")
+    def cmd_stats(self, user, src_chan, *args):
+        """Show the state of the check queue and verdict cache. @stats"""
+
+        self.notice(user.split('!', 1)[0], ", ".join("{}: {}".format(key,
+            value) for key, value in sorted(self.queue.stats().items())))
+        self.notice(user.split('!', 1)[0], "verdict cache: " + ", ".join(
+            "{}: {}".format(key, value) for key, value in
+            sorted(self.engine.cache.stats().items())))
+
+
+def _build_help(cls):
+    """Return the help line of every command of a bot class by name."""
+    return OrderedDict((name[4:], "@%s - %s" % (name[4:],
+        getattr(cls, name).__doc__)) for name in sorted(dir(cls))
+        if name.startswith("cmd_"))
+
+
+# Built once, instead of looking through dir() on every @help.
+Bot.help = _build_help(Bot)
@@ -2,60 +2,73 @@
 
 from twisted.internet import protocol, reactor
 from twisted.python import log
-from pymongo import MongoClient
-import pymongo
 from .bot import Bot
+from .core import Core, network_configs
 
 
 class BotFactory(protocol.ReconnectingClientFactory):
     """A factory for Bots.
 
     A new protocol instance will be created each time we connect to the server.
+
+    Every network has its own factory with its own identity and linerate.
+    The state shared by all networks is in core, and its attributes can be
+    read from the factory as if they were its own. Without a core given, the
+    factory has a core of its own which it starts and stops itself.
     """
 
     protocol = Bot
+    quitting = False
 
-    def __init__(self, config):
+    def __init__(self, config, network=None, core=None):
         """Init"""
+        network = network or network_configs(config)[0]
 
-        self.nickname = config['network'].get('nickname',
+        self.name = network["name"]
+        self.nickname = network.get('nickname',
             config["identity"]["nickname"]).encode('utf8')
-        self.password = config['network']['password'].encode('utf8')
-        self.username = config['network'].get('username',
+        self.password = network['password'].encode('utf8')
+        self.username = network.get('username',
             config["identity"]["nickname"]).encode('utf8')
-        self.realname = config['network'].get('realname',
+        self.realname = network.get('realname',
             config["identity"]["nickname"]).encode('utf8')
-        self.linerate = config['general']['linerate']
-        self.dbclient = None
-        self.db = None
+        self.linerate = network.get('linerate', config['general']['linerate'])
         self.config = config
+        self.core = core or Core(config)
+        self._own_core = core is None
+
+    def __getattr__(self, name):
+        """Return an attribute of the core."""
+        if name.startswith("_") or name == "core":
+            raise AttributeError(name)
+
+        return getattr(self.core, name)
 
     def startFactory(self):
         """Called when starting factory"""
-        self.dbclient = MongoClient(self.config["database"]["uri"])
-        self.db = self.dbclient[self.config["database"]["database"]]
-        self.db.users.ensure_index("username", unique=True)
-        self.db.users.ensure_index(
-            [("hostmask", pymongo.ASCENDING),
-            ("password", pymongo.ASCENDING),
-            ("role", pymongo.ASCENDING),
-            ("nick", pymongo.ASCENDING)])
-        self.db.kicklist.ensure_index("hostmask", unique=True)
-        self.db.chan_settings.ensure_index("channel", unique=True)
-        self.db.ignore.ensure_index("hostmask", unique=True)
+        if self._own_core:
+            self.core.start()
 
         protocol.ReconnectingClientFactory.startFactory(self)
 
     def stopFactory(self):
         """Called when stopping factory"""
-        self.dbclient.disconnect()
         protocol.ReconnectingClientFactory.stopFactory(self)
 
-        if reactor.running:
-            reactor.stop()
+        if self._own_core:
+            self.core.stop()
+
+            if reactor.running:
+                reactor.stop()
 
     def clientConnectionLost(self, connector, reason):
         """If we get disconnected, reconnect to server."""
+        if self.quitting:
+            # @quit shuts the bot down on every network, not just this one.
+            if reactor.running:
+                reactor.stop()
+
+            return
 
         protocol.ReconnectingClientFactory.clientConnectionLost(self,
             connector, reason)
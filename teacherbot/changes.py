@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import uuid
+from twisted.internet import defer, task
+from twisted.python import log
+
+
+BADWORDS = "badwords"
+CHAN_SETTINGS = "chan_settings"
+IGNORE = "ignore"
+USER = "user"
+
+
+class ChangeFeed(object):
+    """Tells other instances of the bot about changes to cached state.
+
+    Every change made here is published as a small document naming what
+    changed, e.g. the badwords of a channel, and the feed is read every
+    interval seconds. Changes published by other instances, or by the
+    teacherbot-words command, are passed to apply, which reloads only what
+    changed. The feed is bounded in the backend, so an instance that falls
+    too far behind misses changes until its caches expire or are reloaded.
+    """
+
+    def __init__(self, db, apply, interval=1.0):
+        """Init"""
+        self._db = db
+        self._apply = apply
+        self._loop = task.LoopingCall(self.poll)
+        self._polling = False
+        self.interval = interval
+        self.origin = uuid.uuid4().hex
+        self.position = None
+
+    def start(self):
+        """Start reading the changes published from now on."""
+
+        def started(position):
+            """Called with the position of the newest change."""
+            self.position = position
+
+            if not self._loop.running:
+                self._loop.start(self.interval, now=False)
+
+        return self._db.last_change().addCallback(started).addErrback(
+            log.err, "Could not start the change feed")
+
+    def stop(self):
+        """Stop reading changes."""
+        if self._loop.running:
+            self._loop.stop()
+
+    def publish(self, kind, key):
+        """Publish a change to the cached state for key."""
+        return self._db.publish_change({"origin": self.origin, "kind": kind,
+            "key": key}).addErrback(log.err, "Could not publish change")
+
+    def poll(self):
+        """Read and apply the changes published since the last poll."""
+        if self._polling:
+            return
+
+        self._polling = True
+        d = self._db.changes_after(self.position).addCallback(self._read)
+        d.addErrback(log.err, "Could not read the change feed")
+        d.addBoth(self._polled)
+        return d
+
+    def _polled(self, result):
+        """Called when a poll is done."""
+        self._polling = False
+
+    @defer.inlineCallbacks
+    def _read(self, changes):
+        """Apply changes one by one, in order."""
+        for position, change in changes:
+            self.position = position
+
+            if change.get("origin") == self.origin:
+                continue
+
+            try:
+                yield self._apply(change["kind"], change["key"])
+            except Exception:
+                log.err(None, "Could not apply change {!r}".format(change))
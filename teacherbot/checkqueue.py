@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import deque
+from twisted.internet import reactor
+from twisted.python import log
+import metrics
+
+
+DROP = "drop"
+SAMPLE = "sample"
+LITERAL = "literal"
+
+
+class CheckQueue(object):
+    """A bounded queue of messages waiting to be checked for badwords.
+
+    Every channel has its own queue and the channels take turns, so a flood
+    in one channel can't starve the others. A channel is never part of more
+    than one running batch, which keeps the verdicts of a user in a channel
+    in order.
+
+    Messages are collected for up to window seconds, or until batch_size
+    messages are waiting, and then checked in one call so the cost of a
+    thread hop is shared by the whole batch.
+
+    Once the queue is half full the policy decides what happens to new
+    messages: "drop" keeps accepting them, "sample" only checks every
+    sample:th message and "literal" checks them against literal words only.
+    Messages are always dropped when the queue is full.
+
+    check is called with a list of (channel, msg, literal_only) and must
+    return a Deferred firing with a list of verdicts in the same order. Each
+    verdict is passed on as verdict(result, user, channel).
+    """
+
+    def __init__(self, check, verdict, depth=1000, policy=DROP, sample=10,
+        workers=4, window=0.01, batch_size=100, clock=reactor):
+        """Init"""
+        if policy not in (DROP, SAMPLE, LITERAL):
+            raise ValueError("Unknown overload policy %r" % policy)
+
+        self._check = check
+        self._verdict = verdict
+        self._clock = clock
+        self.maxdepth = depth
+        self.policy = policy
+        self.sample = sample
+        self.workers = workers
+        self.window = window
+        self.batch_size = batch_size
+        self._queues = {}
+        self._ready = deque()
+        self._busy = set()
+        self._running = 0
+        self._timer = None
+        self._skip = 0
+        self.depth = 0
+        self.checked = 0
+        self.batches = 0
+        self.dropped = 0
+        self.sampled = 0
+        self.degraded = 0
+
+    def put(self, user, channel, msg):
+        """Queue a message. Returns False if it was shed."""
+        literal_only = False
+
+        if self.depth >= self.maxdepth:
+            self.dropped += 1
+            metrics.MESSAGES.inc(result="dropped")
+            return False
+
+        if self.depth >= self.maxdepth // 2:
+            if self.policy == SAMPLE:
+                self._skip = (self._skip + 1) % self.sample
+
+                if self._skip:
+                    self.sampled += 1
+                    metrics.MESSAGES.inc(result="sampled")
+                    return False
+            elif self.policy == LITERAL:
+                literal_only = True
+                self.degraded += 1
+                metrics.MESSAGES.inc(result="degraded")
+
+        if channel not in self._queues:
+            self._queues[channel] = deque()
+
+            if channel not in self._busy:
+                self._ready.append(channel)
+
+        self._queues[channel].append((user, msg, literal_only, time.time()))
+        self.depth += 1
+        metrics.MESSAGES.inc(result="queued")
+
+        if self.depth >= self.batch_size:
+            self._run()
+        elif self._timer is None:
+            self._timer = self._clock.callLater(self.window, self._flush)
+
+        return True
+
+    def stats(self):
+        """Return the counters of the queue."""
+        return {
+            "depth": self.depth,
+            "running": self._running,
+            "channels": len(self._queues),
+            "checked": self.checked,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "sampled": self.sampled,
+            "degraded": self.degraded
+            }
+
+    def _flush(self):
+        """Called when the batch window has passed."""
+        self._timer = None
+        self._run()
+
+    def _run(self):
+        """Start batches until all workers are busy."""
+        if self._timer is not None and self.depth >= self.batch_size:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._ready and self._running < self.workers:
+            self._start(self._take())
+
+    def _take(self):
+        """Take a batch from the queues, one message per channel per turn."""
+        batch = []
+        channels = set()
+        turns, self._ready = self._ready, deque()
+
+        while turns and len(batch) < self.batch_size:
+            channel = turns.popleft()
+            queue = self._queues[channel]
+            user, msg, literal_only, queued = queue.popleft()
+            batch.append((user, channel, msg, literal_only, queued))
+            channels.add(channel)
+            self.depth -= 1
+
+            if queue:
+                turns.append(channel)
+            else:
+                del self._queues[channel]
+
+        self._ready.extend(channel for channel in turns
+            if channel not in channels)
+        self._busy.update(channels)
+        return batch, channels
+
+    def _start(self, taken):
+        """Check a batch."""
+        batch, channels = taken
+        self._running += 1
+        self.batches += 1
+        now = time.time()
+
+        for user, channel, msg, literal_only, queued in batch:
+            metrics.QUEUE_WAIT_SECONDS.observe(now - queued)
+
+        d = metrics.CHECK_SECONDS.time(self._check([(channel, msg,
+            literal_only) for user, channel, msg, literal_only, queued
+            in batch]))
+        d.addCallback(self._fan_out, batch)
+        d.addErrback(log.err)
+        d.addBoth(self._done, channels, len(batch))
+
+    def _fan_out(self, verdicts, batch):
+        """Pass every verdict of a batch on."""
+        now = time.time()
+
+        for verdict, (user, channel, msg, literal_only, queued) in zip(
+            verdicts, batch):
+            metrics.VERDICT_SECONDS.observe(now - queued)
+
+            try:
+                self._verdict(verdict, user, channel)
+            except Exception:
+                log.err()
+
+    def _done(self, result, channels, size):
+        """Called when a batch is done."""
+        self.checked += size
+        self._running -= 1
+        self._busy.difference_update(channels)
+        self._ready.extend(channel for channel in channels
+            if channel in self._queues)
+        self._run()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+import time
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+from badwords import Badwords
+import changes
+from database import Database, open_backend
+from sessions import SessionTable
+from settings import ChannelSettings
+from kicklist import KickList
+from logins import LoginUpdates
+from floods import FloodDetector
+from eventlog import EventLog
+
+
+# Seconds before a failed warm start is tried again, doubled every time it
+# fails again up to WARM_RETRY_MAX.
+WARM_RETRY = 1.0
+WARM_RETRY_MAX = 60.0
+
+
+def network_configs(config):
+    """Return the configs of all networks, each with a name.
+
+    The config has either a list of networks or a single network.
+    """
+    networks = config.get("networks") or [config["network"]]
+    return [dict(network, name=network.get("name", network.get("host",
+        "default"))) for network in networks]
+
+
+class Core(object):
+    """The state shared by the connections to all networks.
+
+    Holds the database pool, the badword engine and all caches, so there is
+    one copy of each however many networks the bot is on. The caches are
+    loaded once and stay warm across reconnects.
+    """
+
+    def __init__(self, config):
+        """Init"""
+        self.config = config
+        self.db = None
+        self.ignored = frozenset()
+        self.chan_settings = {}
+        self.kicklist = None
+        self.logins = None
+        self.engine = None
+        self.feed = None
+        self.events = EventLog()
+        self.sessions = SessionTable(config['general'].get('session_ttl', 300))
+        self.floods = FloodDetector(config['general'].get('flood_idle', 300))
+        self._warm = None
+        self._waiting = []
+        self._retry = None
+        self._delay = 0
+
+    def start(self):
+        """Connect to database and start the engine."""
+        general = self.config['general']
+        self.db = Database(self.make_backend(),
+            self.config["database"].get("threads", 4))
+        self.db.start()
+        self.kicklist = KickList(self.db, general.get('kicklist_flush', 0.25))
+        self.kicklist.start()
+        self.logins = LoginUpdates(self.db, general.get('login_flush', 0.25),
+            general.get('split_flush', 2.0))
+        self.engine = Badwords(self.db, general.get('engine_processes', 0),
+            general.get('match_budget'), general.get('verdict_cache', 10000),
+            general.get('verdict_ttl', 60))
+        self.feed = changes.ChangeFeed(self.db, self.apply_change,
+            general.get('change_poll', 1.0))
+
+        if self.feed.interval:
+            self.feed.start()
+
+        events = self.config.get('events', {})
+        self.events = EventLog(events.get('path'), events.get('flush', 1.0),
+            events.get('buffer', 10000),
+            events.get('max_bytes', 64 * 1024 * 1024),
+            events.get('max_age', 86400), events.get('keep', 7))
+        self.events.start()
+        self._warm = None
+        self._delay = 0
+
+    def stop(self):
+        """Write what is queued, stop the engine and disconnect."""
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+
+        self.feed.stop()
+        self.engine.stop()
+        self.kicklist.stop()
+        self.logins.stop()
+        self.events.stop()
+        self.db.stop()
+
+    def make_backend(self):
+        """Create the database backend from config."""
+        return open_backend(self.config["database"])
+
+    def warm_start(self):
+        """Load all caches from database, unless that is already done.
+
+        Returns a Deferred that fires once the caches are loaded. A failed
+        load is tried again with backoff until it succeeds.
+        """
+        if self._warm:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+
+        if self._warm is None:
+            self._warm = False
+            self._load()
+
+        return d
+
+    def _load(self):
+        """Load all caches from database."""
+        self._retry = None
+        start = time.time()
+        defer.gatherResults([
+            self.engine.load(),
+            self.load_ignore(),
+            self.load_chan_settings(),
+            self.load_sessions(),
+            self.kicklist.load()
+            ], consumeErrors=True).addBoth(self._warmed, start)
+
+    def _warmed(self, result, start):
+        """Called when the warm start is done."""
+        if isinstance(result, failure.Failure):
+            self._delay = min(self._delay * 2 or WARM_RETRY, WARM_RETRY_MAX)
+            log.err(result, "Warm start failed, trying again in {:g}s".format(
+                self._delay))
+            self._retry = reactor.callLater(self._delay, self._load)
+            return
+
+        self._warm = True
+        self._delay = 0
+        log.msg("Warm start took {:.3f}s.".format(time.time() - start))
+        waiting, self._waiting = self._waiting, []
+
+        for d in waiting:
+            d.callback(None)
+
+    def publish(self, kind, key):
+        """Tell other instances that the cached state for key changed."""
+        if not self.feed.interval:
+            return defer.succeed(None)
+
+        return self.feed.publish(kind, key)
+
+    def apply_change(self, kind, key):
+        """Reload the cached state for key after another instance changed it.
+        """
+        if kind == changes.BADWORDS:
+            return self.engine.reload(key)
+        elif kind == changes.CHAN_SETTINGS:
+            return self.load_chan_settings_for(key)
+        elif kind == changes.IGNORE:
+            self.ignore(key)
+        elif kind == changes.USER:
+            return self.load_user(key)
+        else:
+            log.msg("Unknown change {} of {!r}".format(kind, key))
+
+    def ignore(self, hostmask):
+        """Add a hostmask to the cached ignore list."""
+        self.ignored = self.ignored | {hostmask}
+
+    def load_ignore(self):
+        """Load the ignore list from database into memory.
+
+        The set is replaced as a whole so readers never see a partial list.
+        """
+
+        def loaded(hostmasks):
+            """Called with the ignored hostmasks."""
+            self.ignored = frozenset(hostmasks)
+            log.msg("Loaded {} ignored hostmasks.".format(len(self.ignored)))
+
+        return self.db.ignored().addCallback(loaded)
+
+    def load_chan_settings(self):
+        """Load the settings of all channels from database into memory."""
+
+        def loaded(docs):
+            """Called with the chan_settings documents."""
+            self.chan_settings = dict((doc["channel"],
+                ChannelSettings.from_doc(doc)) for doc in docs)
+            log.msg("Loaded settings for {} channels.".format(
+                len(self.chan_settings)))
+
+        return self.db.chan_settings().addCallback(loaded)
+
+    def load_chan_settings_for(self, channel):
+        """Load the settings of one channel from database again."""
+
+        def loaded(doc):
+            """Called with the chan_settings document, if any."""
+            if doc is None:
+                self.chan_settings.pop(channel, None)
+            else:
+                self.chan_settings[channel] = ChannelSettings.from_doc(doc)
+
+        return self.db.chan_settings_for(channel).addCallback(loaded)
+
+    def load_user(self, username):
+        """Load the session of one user from database again."""
+
+        def loaded(doc):
+            """Called with the user document, if any."""
+            if doc is None:
+                self.sessions.drop_username(username)
+            else:
+                self.sessions.update(doc)
+
+        return self.db.user_by_name(username).addCallback(loaded)
+
+    def load_sessions(self):
+        """Load the sessions of the users that are logged in."""
+
+        def loaded(docs):
+            """Called with the logged in users."""
+            for doc in docs:
+                self.sessions.set(doc["hostmask"], doc)
+
+            log.msg("Loaded {} sessions.".format(len(docs)))
+
+        return self.db.logged_in_users().addCallback(loaded)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+import metrics
+
+try:
+    from pymongo import MongoClient
+    from pymongo.errors import DuplicateKeyError
+    import pymongo
+except ImportError:
+    # Only needed by the mongo backend.
+    pymongo = None
+
+
+# Bytes kept in the capped collection of changes.
+CHANGES_SIZE = 1024 * 1024
+
+
+class DuplicateError(Exception):
+    """Raised when an insert conflicts with a unique index."""
+
+
+def open_backend(config):
+    """Create the backend described by the database section of config.
+
+    backend is one of "mongo" (the default), "sqlite" or "memory".
+    """
+    kind = config.get("backend", "mongo")
+
+    if kind == "mongo":
+        if pymongo is None:
+            raise RuntimeError("The mongo backend needs pymongo.")
+
+        return MongoBackend(config["uri"], config["database"])
+    elif kind == "sqlite":
+        from localdb import SQLiteBackend
+        return SQLiteBackend(config.get("path", "teacherbot.db"))
+    elif kind == "memory":
+        from localdb import MemoryBackend
+        return MemoryBackend()
+
+    raise ValueError("Unknown database backend: {}".format(kind))
+
+
+class MongoBackend(object):
+    """Blocking operations on the collections of the bot in MongoDB."""
+
+    def __init__(self, uri, database):
+        """Init"""
+        self.client = MongoClient(uri)
+        self.db = self.client[database]
+        self._tail = None
+
+    def close(self):
+        """Disconnect from the server."""
+        self.client.disconnect()
+
+    def ensure_indexes(self):
+        """Create the indexes used by the bot.
+
+        Run once at install and after upgrades with twistd teacherbot-migrate.
+        """
+        self.db.users.ensure_index("username", unique=True)
+        self.db.users.ensure_index(
+            [("hostmask", pymongo.ASCENDING),
+            ("password", pymongo.ASCENDING),
+            ("role", pymongo.ASCENDING),
+            ("nick", pymongo.ASCENDING)])
+        self.db.kicklist.ensure_index("hostmask", unique=True)
+        self.db.chan_settings.ensure_index("channel", unique=True)
+        self.db.ignore.ensure_index("hostmask", unique=True)
+        self.db.badwords.ensure_index([("word", pymongo.ASCENDING),
+            ("channel", pymongo.ASCENDING)])
+
+        self.ensure_changes()
+
+    def ensure_changes(self):
+        """Create the capped collection of the change feed."""
+        if "changes" not in self.db.collection_names():
+            self.db.create_collection("changes", capped=True,
+                size=CHANGES_SIZE)
+
+    # users
+    def user_by_hostmask(self, hostmask, network=None):
+        """Return the user authenticated from a hostmask on a network.
+
+        Users stored without a network are authenticated on any network.
+        """
+        return self.db.users.find_one({"hostmask": hostmask,
+            "network": {"$in": [None, network]}})
+
+    def user_by_name(self, username):
+        """Return a user by username."""
+        return self.db.users.find_one({"username": username})
+
+    def logged_in_users(self):
+        """Return the users that are logged in."""
+        return list(self.db.users.find({"hostmask": {"$nin": ["", None]}}))
+
+    def user_by_login(self, username, password):
+        """Return a user by username and password hash."""
+        return self.db.users.find_one({"username": username,
+            "password": password})
+
+    def insert_user(self, user_doc):
+        """Register a new user."""
+        try:
+            self.db.users.insert(user_doc)
+        except DuplicateKeyError as exc:
+            raise DuplicateError(str(exc))
+
+    def save_user(self, user_doc):
+        """Save a changed user document."""
+        self.db.users.save(user_doc)
+
+    def remove_user(self, user_id):
+        """Remove a user."""
+        self.db.users.remove(user_id)
+
+    def update_logins(self, changes):
+        """Apply logoffs and nick changes in order in one bulk op.
+
+        changes is a list of ("logoff", username) and ("rename", username,
+        nick).
+        """
+        if not changes:
+            return
+
+        bulk = self.db.users.initialize_ordered_bulk_op()
+
+        for change in changes:
+            if change[0] == "logoff":
+                bulk.find({"username": change[1]}).update(
+                    {"$set": {"hostmask": "", "nick": ""}})
+            else:
+                bulk.find({"username": change[1]}).update(
+                    {"$set": {"nick": change[2]}})
+
+        bulk.execute()
+
+    # chan_settings
+    def chan_settings(self):
+        """Return the settings of all channels."""
+        return list(self.db.chan_settings.find())
+
+    def chan_settings_for(self, channel):
+        """Return the settings of a channel."""
+        return self.db.chan_settings.find_one({"channel": channel})
+
+    def save_chan_settings(self, doc):
+        """Save the settings of a channel."""
+        self.db.chan_settings.save(doc)
+
+    def set_chan_setting(self, channel, option, value):
+        """Change a single option of a channel."""
+        self.db.chan_settings.update({"channel": channel},
+            {"$set": {option: value}})
+
+    # kicklist
+    def kicklist(self):
+        """Return all offence counters."""
+        return list(self.db.kicklist.find())
+
+    def update_kicklist(self, updates):
+        """Apply a dict of hostmask -> update document in one bulk op."""
+        if not updates:
+            return
+
+        bulk = self.db.kicklist.initialize_unordered_bulk_op()
+
+        for hostmask, update in updates.items():
+            bulk.find({"hostmask": hostmask}).upsert().update_one(update)
+
+        bulk.execute()
+
+    # ignore
+    def ignored(self):
+        """Return all ignored hostmasks."""
+        return [doc["hostmask"] for doc in
+            self.db.ignore.find({}, {"_id": False, "hostmask": True})]
+
+    def add_ignore(self, hostmask):
+        """Ignore a hostmask."""
+        try:
+            self.db.ignore.insert({"hostmask": hostmask})
+        except DuplicateKeyError as exc:
+            raise DuplicateError(str(exc))
+
+    # badwords
+    def badwords(self, channel=None):
+        """Return the badwords of a channel, or of all channels."""
+        query = {} if channel is None else {"channel": channel}
+        return list(self.db.badwords.find(query, {"_id": False}))
+
+    def add_badword(self, word, channel):
+        """Blacklist a word in a channel."""
+        self.db.badwords.insert({"word": word, "channel": channel})
+
+    def add_badwords(self, words, channel):
+        """Blacklist many words in a channel with one insert.
+
+        Words the channel already has are skipped. Returns the added words.
+        """
+        existing = set(doc["word"] for doc in self.db.badwords.find(
+            {"channel": channel}, {"_id": False, "word": True}))
+        added = [word for word in words if word not in existing]
+
+        if added:
+            self.db.badwords.insert([{"word": word, "channel": channel}
+                for word in added])
+
+        return added
+
+    def delete_badword(self, word, channel):
+        """Remove a word from the blacklist of a channel."""
+        self.db.badwords.remove({"word": word, "channel": channel})
+
+    # changes
+    def publish_change(self, change):
+        """Add a change to the feed."""
+        self.db.changes.insert(dict(change))
+
+    def last_change(self):
+        """Return the position of the newest change, or None."""
+        for doc in self.db.changes.find({}, {"_id": True}).sort("$natural",
+            -1).limit(1):
+            return doc["_id"]
+
+    def changes_after(self, position):
+        """Return a list of (position, change) published after position.
+
+        The capped collection is read with a tailable cursor that is kept
+        open between calls, so each call only returns what is new. The
+        cursor is opened again after position when the server drops it.
+        """
+        if self._tail is None or not self._tail.alive:
+            query = {} if position is None else {"_id": {"$gt": position}}
+            self._tail = self.db.changes.find(query, tailable=True)
+
+        return [(doc.pop("_id"), doc) for doc in self._tail]
+
+
+class Database(object):
+    """Non-blocking access to a backend.
+
+    Every public method of the backend is available here but runs in a
+    dedicated thread pool and returns a Deferred, so the reactor never waits
+    for the database and database calls don't compete with other work for
+    the reactor's own thread pool.
+    """
+
+    def __init__(self, backend, threads=4):
+        """Init"""
+        self.backend = backend
+        self.pool = ThreadPool(1, threads, name="teacherbot-db")
+        self._trigger = None
+
+    def start(self):
+        """Start the thread pool."""
+        if not self.pool.started:
+            self.pool.start()
+            self._trigger = reactor.addSystemEventTrigger("during",
+                "shutdown", self.stop)
+
+    def stop(self):
+        """Stop the thread pool and disconnect."""
+        trigger, self._trigger = self._trigger, None
+
+        try:
+            if trigger is not None:
+                reactor.removeSystemEventTrigger(trigger)
+        except ValueError:
+            # The trigger is already running, it is this very call.
+            pass
+
+        if self.pool.started:
+            self.pool.stop()
+            self.backend.close()
+
+    def run(self, func, *args, **kwargs):
+        """Run func in the thread pool and return a Deferred."""
+        return metrics.DB_SECONDS.time(threads.deferToThreadPool(reactor,
+            self.pool, func, *args, **kwargs), operation=func.__name__)
+
+    def __getattr__(self, name):
+        """Return a Deferred returning version of a backend method."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        func = getattr(self.backend, name)
+
+        def call(*args, **kwargs):
+            """Run the backend method in the thread pool."""
+            return self.run(func, *args, **kwargs)
+
+        call.__name__ = name
+        return call
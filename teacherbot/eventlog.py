@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import os
+import time
+from collections import Counter
+from twisted.internet import task, threads
+from twisted.python import log
+import metrics
+
+
+def _text(value):
+    """Return a field as text, IRC bytes are not always utf8."""
+    if isinstance(value, bytes):
+        return value.decode("utf8", "replace")
+
+    return value
+
+
+class EventLog(object):
+    """Moderation events appended to a file as JSON lines.
+
+    Events are buffered in memory and written in batches from a thread
+    every interval seconds, one batch at a time. At most buffer events wait
+    to be written; when the disk can't keep up, new events are dropped and
+    counted instead of growing the buffer. The file is rotated when it is
+    larger than max_bytes or older than max_age seconds, and keep rotated
+    files are kept. Without a path nothing is recorded.
+    """
+
+    def __init__(self, path=None, interval=1.0, buffer=10000,
+        max_bytes=64 * 1024 * 1024, max_age=86400, keep=7, clock=time.time):
+        """Init"""
+        self.path = path
+        self.interval = interval
+        self.buffer = buffer
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self._clock = clock
+        self._pending = []
+        self._writing = False
+        self._opened = None
+        self._loop = task.LoopingCall(self.flush)
+
+    def start(self):
+        """Start writing the recorded events."""
+        if self.path and not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        """Stop writing and write what is still buffered."""
+        if self._loop.running:
+            self._loop.stop()
+
+        if self._pending:
+            # Called while shutting down, when a write deferred to the
+            # reactor thread pool might never run.
+            self._write(self._take())
+
+    def record(self, event, **fields):
+        """Record an event with the fields that describe it."""
+        if not self.path:
+            return
+
+        if len(self._pending) >= self.buffer:
+            metrics.EVENTS.inc(result="dropped")
+            return
+
+        fields = dict((key, _text(value)) for key, value in fields.items())
+        fields.update(time=self._clock(), event=event)
+        self._pending.append(fields)
+
+    def flush(self):
+        """Write the buffered events, unless a write is still running."""
+        if self._writing or not self._pending:
+            return
+
+        self._writing = True
+        d = threads.deferToThread(self._write, self._take())
+        d.addErrback(log.err, "Could not write moderation events")
+        d.addBoth(self._written)
+        return d
+
+    def _written(self, result):
+        """Called when a batch is written."""
+        self._writing = False
+
+    def _take(self):
+        """Return the buffered events and start a new buffer."""
+        pending, self._pending = self._pending, []
+        return pending
+
+    def _write(self, events):
+        """Append events to the file, rotating it first if needed."""
+        lines = "".join(json.dumps(event, sort_keys=True) + "\n"
+            for event in events)
+
+        self._rotate()
+
+        with open(self.path, "ab") as f:
+            f.write(lines.encode("ascii"))
+
+        metrics.EVENTS.inc(len(events), result="written")
+
+    def _rotate(self):
+        """Move the file aside when it is too large or too old."""
+        now = self._clock()
+
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            self._opened = now
+            return
+
+        if self._opened is None:
+            self._opened = os.path.getmtime(self.path)
+
+        if size < self.max_bytes and now - self._opened < self.max_age:
+            return
+
+        os.rename(self.path, "{}.{}".format(self.path,
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(now))))
+        self._opened = now
+
+        for old in rotated(self.path)[:-self.keep or None]:
+            os.remove(old)
+
+
+def rotated(path):
+    """Return the rotated files of a log, oldest first."""
+    return sorted(glob.glob(path + ".*"))
+
+
+def read(paths, events=None):
+    """Yield the events in files, optionally only some kinds of events.
+
+    Lines that can't be parsed, like the last one of a file that is being
+    written, are skipped.
+    """
+    if events is not None:
+        # Cheap test before parsing, since most lines are left out.
+        needles = ['"event": "{}"'.format(event) for event in events]
+
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.decode("utf8")
+
+                if events is not None and not any(needle in line for needle
+                    in needles):
+                    continue
+
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def aggregate(paths, by=("channel", ), events=None):
+    """Count events per value of the fields in by.
+
+    Returns a dict of (values of by) -> Counter of event kinds.
+    """
+    counts = {}
+
+    for event in read(paths, events):
+        key = tuple(event.get(field) for field in by)
+
+        try:
+            counter = counts[key]
+        except KeyError:
+            counter = counts[key] = Counter()
+
+        counter[event["event"]] += 1
+
+    return counts
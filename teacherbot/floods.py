@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+from array import array
+
+
+FLOOD = "flood"
+REPEAT = "repeat"
+
+# The time of an empty slot, before any window.
+_EMPTY = float("-inf")
+
+
+class Window(object):
+    """The last messages of a user in a channel, in fixed size rings."""
+
+    __slots__ = ("times", "digests", "position", "last")
+
+    # Messages remembered; larger thresholds are capped to this.
+    SIZE = 16
+
+    def __init__(self):
+        """Init"""
+        self.times = array("d", [_EMPTY]) * self.SIZE
+        self.digests = array("i", [0]) * self.SIZE
+        self.position = 0
+        self.last = 0.0
+
+    def add(self, now, digest):
+        """Remember a message."""
+        self.times[self.position] = now
+        self.digests[self.position] = digest
+        self.position = (self.position + 1) % self.SIZE
+        self.last = now
+
+    def count(self, since, digest=None):
+        """Count the messages since a time, optionally only those equal."""
+        count = 0
+
+        for i in range(self.SIZE):
+            if self.times[i] >= since and (digest is None or
+                self.digests[i] == digest):
+                count += 1
+
+        return count
+
+    def clear(self):
+        """Forget all messages."""
+        for i in range(self.SIZE):
+            self.times[i] = _EMPTY
+
+
+class FloodDetector(object):
+    """Detects floods and repeated messages per user and channel.
+
+    A user floods when sending flood_lines messages within flood_seconds,
+    and repeats when the same message is sent repeats times within
+    repeat_seconds; the thresholds are taken from the channel settings and
+    0 turns a check off. Windows not used for idle seconds are dropped.
+    """
+
+    def __init__(self, idle=300, clock=time.time):
+        """Init"""
+        self._windows = {}
+        self._clock = clock
+        self._swept = clock()
+        self.idle = idle
+
+    def __len__(self):
+        """Return the number of windows."""
+        return len(self._windows)
+
+    def check(self, channel, hostmask, msg, cs):
+        """Record a message. Returns FLOOD, REPEAT or None."""
+        now = self._clock()
+
+        if now - self._swept > self.idle:
+            self._sweep(now)
+
+        try:
+            window = self._windows[channel, hostmask]
+        except KeyError:
+            window = self._windows[channel, hostmask] = Window()
+
+        digest = zlib.crc32(msg.strip().lower()) & 0x7fffffff
+        window.add(now, digest)
+        result = None
+
+        if cs.flood_lines and window.count(now - cs.flood_seconds) >= min(
+            cs.flood_lines, Window.SIZE):
+            result = FLOOD
+        elif cs.repeats and window.count(now - cs.repeat_seconds,
+            digest) >= min(cs.repeats, Window.SIZE):
+            result = REPEAT
+
+        if result is not None:
+            # One burst is one offence.
+            window.clear()
+
+        return result
+
+    def _sweep(self, now):
+        """Drop the windows that have been idle."""
+        self._swept = now
+
+        for key, window in list(self._windows.items()):
+            if now - window.last > self.idle:
+                del self._windows[key]
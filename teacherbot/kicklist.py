@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import task
+from twisted.python import log
+
+
+class Offender(object):
+    """The warn and kick counters of a hostmask."""
+
+    __slots__ = ("nickname", "channel", "warns", "kicks")
+
+    def __init__(self, nickname, channel, warns=0, kicks=0):
+        """Init"""
+        self.nickname = nickname
+        self.channel = channel
+        self.warns = warns
+        self.kicks = kicks
+
+
+class KickList(object):
+    """Offence counters kept in memory and written behind to database.
+
+    Decisions are made from the in-memory counters so they are immediate and
+    consistent even when the same user offends many times in a row. Every
+    change is turned into an atomic $inc/$set update which is queued per
+    hostmask and flushed in one bulk operation every interval seconds.
+    """
+
+    def __init__(self, db, interval=0.25):
+        """Init"""
+        self._db = db
+        self._records = {}
+        self._pending = {}
+        self._loop = task.LoopingCall(self.flush)
+        self.interval = interval
+
+    def load(self):
+        """Load the counters from database."""
+        return self._db.kicklist().addCallback(self._loaded)
+
+    def _loaded(self, docs):
+        """Called with the kicklist documents."""
+        for doc in docs:
+            if doc["hostmask"] not in self._records:
+                self._records[doc["hostmask"]] = Offender(doc["nickname"],
+                    doc["channel"], doc["warns"], doc["kicks"])
+
+    def start(self):
+        """Start flushing the queued updates."""
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        """Stop flushing and write what is still queued."""
+        if self._loop.running:
+            self._loop.stop()
+
+        # Core.stop stops the database pool right after this, so counters
+        # bumped since the last flush go straight to the backend.
+        self._db.backend.update_kicklist(self._take())
+
+    def get(self, hostmask, nickname, channel):
+        """Return the counters of a hostmask, creating them if needed."""
+        try:
+            return self._records[hostmask]
+        except KeyError:
+            record = self._records[hostmask] = Offender(nickname, channel)
+            self._update(hostmask)
+            return record
+
+    def warn(self, hostmask):
+        """Count a warning."""
+        self._records[hostmask].warns += 1
+        self._inc(hostmask, "warns")
+
+    def kick(self, hostmask):
+        """Count a kick, which clears the warnings."""
+        record = self._records[hostmask]
+        record.warns = 0
+        record.kicks += 1
+        self._assign(hostmask, "warns", 0)
+        self._inc(hostmask, "kicks")
+
+    def reset(self, hostmask):
+        """Clear all counters, e.g. after a ban."""
+        record = self._records[hostmask]
+        record.warns = 0
+        record.kicks = 0
+        self._assign(hostmask, "warns", 0)
+        self._assign(hostmask, "kicks", 0)
+
+    def _update(self, hostmask):
+        """Return the queued update of a hostmask."""
+        try:
+            return self._pending[hostmask]
+        except KeyError:
+            record = self._records[hostmask]
+            update = self._pending[hostmask] = {
+                "$setOnInsert": {
+                    "nickname": record.nickname,
+                    "channel": record.channel
+                    }
+                }
+            return update
+
+    def _inc(self, hostmask, field):
+        """Queue an increment of field."""
+        update = self._update(hostmask)
+
+        if field in update.get("$set", {}):
+            update["$set"][field] += 1
+        else:
+            inc = update.setdefault("$inc", {})
+            inc[field] = inc.get(field, 0) + 1
+
+    def _assign(self, hostmask, field, value):
+        """Queue an assignment of field, which replaces earlier increments."""
+        update = self._update(hostmask)
+        update.get("$inc", {}).pop(field, None)
+        update.setdefault("$set", {})[field] = value
+
+        if not update.get("$inc", True):
+            del update["$inc"]
+
+    def flush(self):
+        """Write the queued updates."""
+        if self._pending:
+            return self._db.update_kicklist(self._take()).addErrback(log.err,
+                "Could not update kicklist")
+
+    def _take(self):
+        """Return the queued updates and start a new queue."""
+        pending, self._pending = self._pending, {}
+
+        for update in pending.values():
+            # Counters that are neither set nor increased must still exist
+            # when the record is inserted.
+            update["$setOnInsert"].update((field, 0) for field in
+                ("warns", "kicks") if field not in update.get("$inc", {})
+                and field not in update.get("$set", {}))
+
+        return pending
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+"""Backends that need no database server.
+
+MemoryBackend keeps everything in dicts and forgets it on exit, which suits
+tests and trying the bot out. SQLiteBackend stores everything in a local
+file. Both implement the same operations as MongoBackend.
+"""
+
+import copy
+import json
+import sqlite3
+import threading
+from collections import deque
+from database import CHANGES_SIZE, DuplicateError
+
+# Changes kept in the feed, about as many as fit in the capped collection
+# of the mongo backend.
+CHANGES_KEPT = CHANGES_SIZE // 128
+
+
+def _text(value):
+    """Return a string parameter as text."""
+    if isinstance(value, bytes):
+        return value.decode('utf8')
+
+    return value
+
+
+def _apply(doc, update):
+    """Apply a kicklist update document to a record."""
+    for field, value in update.get("$inc", {}).items():
+        doc[field] = doc.get(field, 0) + value
+
+    doc.update(update.get("$set", {}))
+
+
+class MemoryBackend(object):
+    """All data in memory, guarded by a lock."""
+
+    def __init__(self):
+        """Init"""
+        self._lock = threading.Lock()
+        self._users = {}
+        self._next_id = 0
+        self._chan_settings = {}
+        self._kicklist = {}
+        self._ignore = set()
+        self._badwords = []
+        self._changes = deque(maxlen=CHANGES_KEPT)
+        self._last_change = 0
+
+    def close(self):
+        """Nothing to disconnect from."""
+
+    def ensure_indexes(self):
+        """Nothing to index."""
+
+    def _find_user(self, **query):
+        """Return a copy of the first user matching query."""
+        with self._lock:
+            for doc in self._users.values():
+                if all(doc.get(key) == value for key, value in query.items()):
+                    return copy.deepcopy(doc)
+
+    # users
+    def user_by_hostmask(self, hostmask, network=None):
+        """Return the user authenticated from a hostmask on a network."""
+        with self._lock:
+            for doc in self._users.values():
+                if doc.get("hostmask") == hostmask and doc.get("network") in (
+                    None, network):
+                    return copy.deepcopy(doc)
+
+    def user_by_name(self, username):
+        """Return a user by username."""
+        return self._find_user(username=username)
+
+    def logged_in_users(self):
+        """Return the users that are logged in."""
+        with self._lock:
+            return [copy.deepcopy(doc) for doc in self._users.values()
+                if doc.get("hostmask")]
+
+    def user_by_login(self, username, password):
+        """Return a user by username and password hash."""
+        return self._find_user(username=username, password=password)
+
+    def insert_user(self, user_doc):
+        """Register a new user."""
+        with self._lock:
+            if any(doc["username"] == user_doc["username"]
+                for doc in self._users.values()):
+                raise DuplicateError(user_doc["username"])
+
+            self._next_id += 1
+            user_doc["_id"] = self._next_id
+            self._users[self._next_id] = copy.deepcopy(user_doc)
+
+    def save_user(self, user_doc):
+        """Save a changed user document."""
+        with self._lock:
+            self._users[user_doc["_id"]] = copy.deepcopy(user_doc)
+
+    def remove_user(self, user_id):
+        """Remove a user."""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def update_logins(self, changes):
+        """Apply logoffs and nick changes in order."""
+        with self._lock:
+            for change in changes:
+                for doc in self._users.values():
+                    if doc.get("username") != change[1]:
+                        continue
+
+                    if change[0] == "logoff":
+                        doc.update(hostmask="", nick="")
+                    else:
+                        doc["nick"] = change[2]
+
+                    break
+
+    # chan_settings
+    def chan_settings(self):
+        """Return the settings of all channels."""
+        with self._lock:
+            return copy.deepcopy(list(self._chan_settings.values()))
+
+    def chan_settings_for(self, channel):
+        """Return the settings of a channel."""
+        with self._lock:
+            return copy.deepcopy(self._chan_settings.get(channel))
+
+    def save_chan_settings(self, doc):
+        """Save the settings of a channel."""
+        with self._lock:
+            self._chan_settings[doc["channel"]] = copy.deepcopy(doc)
+
+    def set_chan_setting(self, channel, option, value):
+        """Change a single option of a channel."""
+        with self._lock:
+            if channel in self._chan_settings:
+                self._chan_settings[channel][option] = copy.deepcopy(value)
+
+    # kicklist
+    def kicklist(self):
+        """Return all offence counters."""
+        with self._lock:
+            return copy.deepcopy(list(self._kicklist.values()))
+
+    def update_kicklist(self, updates):
+        """Apply a dict of hostmask -> update document."""
+        with self._lock:
+            for hostmask, update in updates.items():
+                if hostmask not in self._kicklist:
+                    self._kicklist[hostmask] = dict(update["$setOnInsert"],
+                        hostmask=hostmask)
+
+                _apply(self._kicklist[hostmask], update)
+
+    # ignore
+    def ignored(self):
+        """Return all ignored hostmasks."""
+        with self._lock:
+            return list(self._ignore)
+
+    def add_ignore(self, hostmask):
+        """Ignore a hostmask."""
+        with self._lock:
+            if hostmask in self._ignore:
+                raise DuplicateError(hostmask)
+
+            self._ignore.add(hostmask)
+
+    # badwords
+    def badwords(self, channel=None):
+        """Return the badwords of a channel, or of all channels."""
+        with self._lock:
+            return [dict(doc) for doc in self._badwords
+                if channel is None or doc["channel"] == channel]
+
+    def add_badword(self, word, channel):
+        """Blacklist a word in a channel."""
+        with self._lock:
+            self._badwords.append({"word": word, "channel": channel})
+
+    def add_badwords(self, words, channel):
+        """Blacklist many words in a channel. Returns the added words."""
+        with self._lock:
+            existing = set(doc["word"] for doc in self._badwords
+                if doc["channel"] == channel)
+            added = [word for word in words if word not in existing]
+            self._badwords.extend({"word": word, "channel": channel}
+                for word in added)
+
+        return added
+
+    def delete_badword(self, word, channel):
+        """Remove a word from the blacklist of a channel."""
+        with self._lock:
+            self._badwords = [doc for doc in self._badwords
+                if (doc["word"], doc["channel"]) != (word, channel)]
+
+    # changes
+    def publish_change(self, change):
+        """Add a change to the feed."""
+        with self._lock:
+            self._last_change += 1
+            self._changes.append((self._last_change, dict(change)))
+
+    def last_change(self):
+        """Return the position of the newest change."""
+        with self._lock:
+            return self._last_change
+
+    def changes_after(self, position):
+        """Return a list of (position, change) published after position."""
+        with self._lock:
+            return [(number, dict(change)) for number, change in self._changes
+                if number > (position or 0)]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password TEXT,
+    hostmask TEXT,
+    nick TEXT,
+    doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chan_settings (
+    channel TEXT PRIMARY KEY,
+    doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS kicklist (
+    hostmask TEXT PRIMARY KEY,
+    nickname TEXT,
+    channel TEXT,
+    warns INTEGER NOT NULL DEFAULT 0,
+    kicks INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS ignore (
+    hostmask TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS badwords (
+    id INTEGER PRIMARY KEY,
+    word TEXT NOT NULL,
+    channel TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc TEXT NOT NULL);
+"""
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS users_hostmask ON users (hostmask);
+CREATE INDEX IF NOT EXISTS users_nick ON users (nick);
+CREATE INDEX IF NOT EXISTS badwords_channel ON badwords (channel, word);
+"""
+
+# The columns of users that are kept out of the JSON document.
+_USER_COLUMNS = ("username", "password", "hostmask", "nick")
+
+# The columns of kicklist an update may change.
+_KICK_COLUMNS = frozenset(("nickname", "channel", "warns", "kicks"))
+
+
+class SQLiteBackend(object):
+    """All data in a local SQLite file.
+
+    Every thread of the database pool gets its own connection. The file is
+    in WAL mode, so reads don't wait for writes. Queries are fixed strings
+    with parameters, so sqlite3 prepares each of them once per connection.
+    The schema is created when the file is opened, which is cheap enough to
+    do every time.
+    """
+
+    def __init__(self, path):
+        """Init"""
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+        self.ensure_indexes()
+
+    def _conn(self):
+        """Return the connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path,
+                check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+            with self._lock:
+                self._connections.append(conn)
+
+        return conn
+
+    def close(self):
+        """Close all connections."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for conn in connections:
+            conn.close()
+
+    def ensure_indexes(self):
+        """Create the indexes used by the bot."""
+        self._conn().executescript(_INDEXES)
+
+    # users
+    def _user(self, row):
+        """Return a user document from a users row."""
+        if row is None:
+            return None
+
+        doc = json.loads(row[5])
+        doc.update(zip(("_id", ) + _USER_COLUMNS, row[:5]))
+        return doc
+
+    def _find_user(self, where, *params):
+        """Return the first user matching a condition."""
+        return self._user(self._conn().execute(
+            "SELECT id, username, password, hostmask, nick, doc FROM users "
+            "WHERE " + where + " LIMIT 1",
+            [_text(param) for param in params]).fetchone())
+
+    def user_by_hostmask(self, hostmask, network=None):
+        """Return the user authenticated from a hostmask on a network."""
+        rows = self._conn().execute(
+            "SELECT id, username, password, hostmask, nick, doc FROM users "
+            "WHERE hostmask = ?", (_text(hostmask), ))
+
+        # The network is in the JSON document, not a column of its own.
+        for row in rows:
+            doc = self._user(row)
+
+            if doc.get("network") in (None, network):
+                return doc
+
+        return None
+
+    def user_by_name(self, username):
+        """Return a user by username."""
+        return self._find_user("username = ?", username)
+
+    def logged_in_users(self):
+        """Return the users that are logged in."""
+        return [self._user(row) for row in self._conn().execute(
+            "SELECT id, username, password, hostmask, nick, doc FROM users "
+            "WHERE hostmask IS NOT NULL AND hostmask != ''")]
+
+    def user_by_login(self, username, password):
+        """Return a user by username and password hash."""
+        return self._find_user("username = ? AND password = ?", username,
+            password)
+
+    def _user_params(self, user_doc):
+        """Return the column values of a user document."""
+        rest = dict((key, value) for key, value in user_doc.items()
+            if key != "_id" and key not in _USER_COLUMNS)
+        return [_text(user_doc.get(column)) for column in _USER_COLUMNS] + [
+            json.dumps(rest)]
+
+    def insert_user(self, user_doc):
+        """Register a new user."""
+        conn = self._conn()
+
+        try:
+            with conn:
+                cursor = conn.execute("INSERT INTO users (username, password, "
+                    "hostmask, nick, doc) VALUES (?, ?, ?, ?, ?)",
+                    self._user_params(user_doc))
+        except sqlite3.IntegrityError as exc:
+            raise DuplicateError(str(exc))
+
+        user_doc["_id"] = cursor.lastrowid
+
+    def save_user(self, user_doc):
+        """Save a changed user document."""
+        conn = self._conn()
+
+        with conn:
+            conn.execute("UPDATE users SET username = ?, password = ?, "
+                "hostmask = ?, nick = ?, doc = ? WHERE id = ?",
+                self._user_params(user_doc) + [user_doc["_id"]])
+
+    def remove_user(self, user_id):
+        """Remove a user."""
+        conn = self._conn()
+
+        with conn:
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id, ))
+
+    def update_logins(self, changes):
+        """Apply logoffs and nick changes in order in one transaction."""
+        if not changes:
+            return
+
+        conn = self._conn()
+
+        with conn:
+            for change in changes:
+                if change[0] == "logoff":
+                    conn.execute("UPDATE users SET hostmask = '', nick = '' "
+                        "WHERE username = ?", (_text(change[1]), ))
+                else:
+                    conn.execute("UPDATE users SET nick = ? "
+                        "WHERE username = ?", (_text(change[2]),
+                        _text(change[1])))
+
+    # chan_settings
+    def chan_settings(self):
+        """Return the settings of all channels."""
+        return [json.loads(row[0]) for row in self._conn().execute(
+            "SELECT doc FROM chan_settings")]
+
+    def chan_settings_for(self, channel):
+        """Return the settings of a channel."""
+        row = self._conn().execute(
+            "SELECT doc FROM chan_settings WHERE channel = ?",
+            (_text(channel), )).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_chan_settings(self, doc):
+        """Save the settings of a channel."""
+        conn = self._conn()
+
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO chan_settings (channel, doc) "
+                "VALUES (?, ?)", (_text(doc["channel"]), json.dumps(doc)))
+
+    def set_chan_setting(self, channel, option, value):
+        """Change a single option of a channel."""
+        conn = self._conn()
+
+        with conn:
+            # Read and write in one transaction, or a concurrent change of
+            # another option of the channel would be lost.
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT doc FROM chan_settings WHERE "
+                "channel = ?", (_text(channel), )).fetchone()
+
+            if row is not None:
+                doc = json.loads(row[0])
+                doc[option] = value
+                conn.execute("UPDATE chan_settings SET doc = ? WHERE "
+                    "channel = ?", (json.dumps(doc), _text(channel)))
+
+    # kicklist
+    def kicklist(self):
+        """Return all offence counters."""
+        return [dict(zip(("hostmask", "nickname", "channel", "warns",
+            "kicks"), row)) for row in self._conn().execute(
+            "SELECT hostmask, nickname, channel, warns, kicks FROM kicklist")]
+
+    def update_kicklist(self, updates):
+        """Apply a dict of hostmask -> update document in one transaction."""
+        if not updates:
+            return
+
+        conn = self._conn()
+
+        with conn:
+            for hostmask, update in updates.items():
+                fields = set(update.get("$inc", {})) | set(
+                    update.get("$set", {}))
+
+                if not fields <= _KICK_COLUMNS:
+                    raise ValueError("Unknown kicklist fields: {}".format(
+                        ", ".join(sorted(fields - _KICK_COLUMNS))))
+
+                insert = update["$setOnInsert"]
+                conn.execute("INSERT OR IGNORE INTO kicklist (hostmask, "
+                    "nickname, channel, warns, kicks) VALUES (?, ?, ?, ?, ?)",
+                    (_text(hostmask), _text(insert.get("nickname")),
+                    _text(insert.get("channel")), insert.get("warns", 0),
+                    insert.get("kicks", 0)))
+
+                for field, value in update.get("$inc", {}).items():
+                    conn.execute("UPDATE kicklist SET %s = %s + ? "
+                        "WHERE hostmask = ?" % (field, field),
+                        (value, _text(hostmask)))
+
+                for field, value in update.get("$set", {}).items():
+                    conn.execute("UPDATE kicklist SET %s = ? "
+                        "WHERE hostmask = ?" % field,
+                        (_text(value), _text(hostmask)))
+
+    # ignore
+    def ignored(self):
+        """Return all ignored hostmasks."""
+        return [row[0] for row in self._conn().execute(
+            "SELECT hostmask FROM ignore")]
+
+    def add_ignore(self, hostmask):
+        """Ignore a hostmask."""
+        conn = self._conn()
+
+        try:
+            with conn:
+                conn.execute("INSERT INTO ignore (hostmask) VALUES (?)",
+                    (_text(hostmask), ))
+        except sqlite3.IntegrityError as exc:
+            raise DuplicateError(str(exc))
+
+    # badwords
+    def badwords(self, channel=None):
+        """Return the badwords of a channel, or of all channels."""
+        if channel is None:
+            rows = self._conn().execute("SELECT word, channel FROM badwords")
+        else:
+            rows = self._conn().execute(
+                "SELECT word, channel FROM badwords WHERE channel = ?",
+                (_text(channel), ))
+
+        return [{"word": word, "channel": channel} for word, channel in rows]
+
+    def add_badword(self, word, channel):
+        """Blacklist a word in a channel."""
+        conn = self._conn()
+
+        with conn:
+            conn.execute("INSERT INTO badwords (word, channel) VALUES (?, ?)",
+                (_text(word), _text(channel)))
+
+    def add_badwords(self, words, channel):
+        """Blacklist many words in a channel. Returns the added words."""
+        conn = self._conn()
+        channel = _text(channel)
+
+        with conn:
+            existing = set(row[0] for row in conn.execute(
+                "SELECT word FROM badwords WHERE channel = ?", (channel, )))
+            added = [word for word in words if _text(word) not in existing]
+            conn.executemany(
+                "INSERT INTO badwords (word, channel) VALUES (?, ?)",
+                [(_text(word), channel) for word in added])
+
+        return added
+
+    def delete_badword(self, word, channel):
+        """Remove a word from the blacklist of a channel."""
+        conn = self._conn()
+
+        with conn:
+            conn.execute("DELETE FROM badwords WHERE word = ? AND channel = ?",
+                (_text(word), _text(channel)))
+
+    # changes
+    def publish_change(self, change):
+        """Add a change to the feed and drop the oldest beyond the limit."""
+        conn = self._conn()
+
+        with conn:
+            cursor = conn.execute("INSERT INTO changes (doc) VALUES (?)",
+                (json.dumps(change), ))
+            conn.execute("DELETE FROM changes WHERE id <= ?",
+                (cursor.lastrowid - CHANGES_KEPT, ))
+
+    def last_change(self):
+        """Return the position of the newest change."""
+        return self._conn().execute(
+            "SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+
+    def changes_after(self, position):
+        """Return a list of (position, change) published after position."""
+        return [(number, json.loads(doc)) for number, doc in
+            self._conn().execute("SELECT id, doc FROM changes WHERE id > ? "
+            "ORDER BY id", (position or 0, ))]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import re
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+# The quit message of a netsplit names the two servers that split.
+_SPLIT = re.compile(r"^[\w.-]+\.[\w-]+ [\w.-]+\.[\w-]+$")
+
+LOGOFF = "logoff"
+RENAME = "rename"
+
+
+class LoginUpdates(object):
+    """Logoffs and nick changes of logged in users, written behind.
+
+    Changes are keyed by username and collected for interval seconds, then
+    written in order with one bulk update, one write after the other. A
+    nick can be taken by someone else before the write, so nicks are never
+    used to find the login. A netsplit is recognized from its "server1
+    server2" quit messages, and while it lasts the window grows to
+    split_interval, so a burst of thousands of quits is a handful of writes.
+    """
+
+    def __init__(self, db, interval=0.25, split_interval=2.0, clock=reactor):
+        """Init"""
+        self._db = db
+        self._clock = clock
+        self._changes = []
+        self._timer = None
+        self._split_until = 0
+        self._lock = defer.DeferredLock()
+        self.interval = interval
+        self.split_interval = split_interval
+
+    def quit(self, message):
+        """Look at the message of a quit. Returns True if it is a netsplit."""
+        if not _SPLIT.match(message):
+            return False
+
+        now = self._clock.seconds()
+
+        if now > self._split_until:
+            log.msg("Netsplit: {}".format(message))
+
+        self._split_until = now + self.split_interval
+        return True
+
+    def logoff(self, username):
+        """Clear the login of a user."""
+        self._put((LOGOFF, username))
+
+    def rename(self, username, newname):
+        """Move the login of a user to a new nick."""
+        self._put((RENAME, username, newname))
+
+    def _put(self, change):
+        """Queue a change."""
+        self._changes.append(change)
+
+        if self._timer is None:
+            if self._clock.seconds() < self._split_until:
+                delay = self.split_interval
+            else:
+                delay = self.interval
+
+            self._timer = self._clock.callLater(delay, self.flush)
+
+    def _take(self):
+        """Remove and return the queued changes."""
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+
+        self._timer = None
+        changes, self._changes = self._changes, []
+        return changes
+
+    def flush(self):
+        """Write the queued changes after the ones already being written.
+
+        Returns a Deferred that fires once they are written.
+        """
+        return self._lock.run(self._db.update_logins, self._take()
+            ).addErrback(log.err)
+
+    def stop(self):
+        """Write what is still queued."""
+        # Users who quit just before shutdown would otherwise stay logged
+        # in; the database pool is stopped next, so use the backend.
+        self._db.backend.update_logins(self._take())
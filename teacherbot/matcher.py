@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+import time
+from collections import deque
+import metrics
+from normalize import fold, literal_pattern
+
+try:
+    import sre_parse
+except ImportError:
+    from re import _parser as sre_parse
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+# Characters that make a word a regex rather than a literal.
+_SPECIAL = re.compile(r"[\\.^$*+?{}\[\]|()]")
+
+LITERAL = "literal"
+REGEX = "regex"
+
+# The longest badword that is accepted.
+MAX_WORD = 200
+
+# The most unbounded repeats a regex may have.
+MAX_REPEATS = 2
+
+# Characters to tell which parts of a regex can match the same thing.
+_SAMPLE = frozenset([unichr(code) for code in range(256)] + [u"\u0430",
+    u"\u03b1", u"\u4e00", u"\u2003", u"\u200b", u"\uff10"])
+
+_CATEGORIES = dict((name, frozenset(char for char in _SAMPLE
+    if re.match(pattern, char, re.U))) for name, pattern in [
+    ("category_digit", r"\d"), ("category_not_digit", r"\D"),
+    ("category_space", r"\s"), ("category_not_space", r"\S"),
+    ("category_word", r"\w"), ("category_not_word", r"\W")])
+
+
+class PatternError(ValueError):
+    """Raised for a badword that can't be used."""
+
+
+def _fold(chars):
+    """Return a set of characters the way re.I compares them."""
+    return frozenset(char.lower() for char in chars)
+
+
+def _category(category):
+    """Return the sample characters of a category like \\d."""
+    return _CATEGORIES.get(str(category).lower(), _SAMPLE)
+
+
+def _in(items):
+    """Return the sample characters matched by a character class."""
+    chars = set()
+    negate = False
+
+    for op, av in items:
+        if op == sre_parse.NEGATE:
+            negate = True
+        elif op == sre_parse.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_parse.RANGE:
+            chars.update(char for char in _SAMPLE if av[0] <= ord(char) <=
+                av[1])
+        elif op == sre_parse.CATEGORY:
+            chars.update(_category(av))
+        else:
+            chars.update(_SAMPLE)
+
+    return _SAMPLE - chars if negate else frozenset(chars)
+
+
+def _first(pattern):
+    """Return the characters a parsed regex can start with.
+
+    Returns the set and whether the regex can match the empty string.
+    """
+    chars = set()
+
+    for op, av in pattern:
+        empty = False
+
+        if op == sre_parse.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_parse.NOT_LITERAL:
+            chars.update(_SAMPLE - set([unichr(av)]))
+        elif op == sre_parse.ANY:
+            chars.update(_SAMPLE - set(u"\n"))
+        elif op == sre_parse.IN:
+            chars.update(_in(av))
+        elif op == sre_parse.CATEGORY:
+            chars.update(_category(av))
+        elif op == sre_parse.SUBPATTERN:
+            sub, empty = _first(av[-1])
+            chars.update(sub)
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                sub, branch_empty = _first(branch)
+                chars.update(sub)
+                empty = empty or branch_empty
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            sub, empty = _first(av[2])
+            chars.update(sub)
+            empty = empty or av[0] == 0
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            empty = True
+        else:
+            chars.update(_SAMPLE)
+
+        if not empty:
+            return _fold(chars), False
+
+    return _fold(chars), True
+
+
+def _variable(op, av):
+    """Tell whether an item of a parsed regex is a repeat of varying count."""
+    return op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and \
+        av[0] != av[1]
+
+
+def _items(pattern):
+    """Yield the items of a parsed regex with plain groups flattened."""
+    for op, av in pattern:
+        if op == sre_parse.SUBPATTERN:
+            for item in _items(av[-1]):
+                yield item
+        else:
+            yield op, av
+
+
+def _check_sequence(pattern):
+    """Refuse repeats next to each other that can take the same characters.
+
+    Like \\w*\\w* or x?x?x?, which try every way of splitting a text.
+    """
+    previous = []
+
+    for op, av in _items(pattern):
+        if _variable(op, av):
+            chars, empty = _first(av[2])
+
+            if any(chars & other for other in previous):
+                raise PatternError("repeats next to each other that can "
+                    "match the same characters")
+
+            previous.append(chars)
+        elif not _first([(op, av)])[1]:
+            # Something that must match separates the repeats.
+            previous = []
+
+
+def _check_branches(pattern):
+    """Refuse alternatives in a repeat that can start the same way."""
+    for op, av in _items(pattern):
+        if op == sre_parse.BRANCH:
+            seen = set()
+
+            for branch in av[1]:
+                chars, empty = _first(branch)
+
+                if empty or chars & seen:
+                    raise PatternError("alternatives in a repeat that can "
+                        "match the same characters, like (a|ab)*")
+
+                seen.update(chars)
+                _check_branches(branch)
+
+
+def _repeats(pattern, nested=False):
+    """Count the unbounded repeats of a parsed regex.
+
+    Raises PatternError for constructs that can backtrack exponentially.
+    """
+    count = 0
+    _check_sequence(pattern)
+
+    for op, av in pattern:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, sub = av
+            unbounded = high == sre_parse.MAXREPEAT
+
+            if nested and _variable(op, av):
+                raise PatternError("nested repeats, like (a+)+, (.?.?)* "
+                    "or (a?){25}")
+
+            if high > 1:
+                _check_branches(sub)
+
+            if unbounded and _first(sub)[1]:
+                raise PatternError("a repeat of something that can be empty")
+
+            # A body repeated more than once may not vary in length either,
+            # bounded counts like {1,32000} backtrack just as badly.
+            count += unbounded + _repeats(sub, nested or high > 1)
+        elif op == sre_parse.SUBPATTERN:
+            count += _repeats(av[-1], nested)
+        elif op == sre_parse.BRANCH:
+            count += sum(_repeats(sub, nested) for sub in av[1])
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            count += _repeats(av[1], nested)
+        elif op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise PatternError("backreferences")
+
+    return count
+
+
+def uncapture(pattern):
+    """Return a regex with all its groups made non-capturing.
+
+    The words of a channel are joined into one regex, and py2 re refuses
+    regexes with more than 100 groups. Backreferences are refused by
+    classify, so no group is ever referred to.
+    """
+    out = []
+    position = 0
+    in_class = False
+
+    while position < len(pattern):
+        char = pattern[position]
+
+        if char == "\\":
+            out.append(pattern[position:position + 2])
+            position += 2
+            continue
+
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            # A ] right after [ or [^ is a literal.
+            end = position + 1
+
+            if pattern[end:end + 1] == "^":
+                end += 1
+
+            if pattern[end:end + 1] == "]":
+                end += 1
+
+            out.append(pattern[position:end])
+            position = end
+            in_class = True
+            continue
+        elif char == "(" and pattern[position + 1:position + 2] != "?":
+            out.append(u"(?:")
+            position += 1
+            continue
+        elif char == "(" and pattern[position + 1:position + 4] == "?P<":
+            out.append(u"(?:")
+            position = pattern.index(">", position) + 1
+            continue
+
+        out.append(char)
+        position += 1
+
+    return u"".join(out)
+
+
+def classify(word):
+    """Return LITERAL or REGEX for a badword.
+
+    Raises PatternError if the word is not a valid regex or if it could take
+    exponential time to match.
+    """
+    if not word:
+        raise PatternError("empty word")
+
+    if len(word) > MAX_WORD:
+        raise PatternError("longer than {} characters".format(MAX_WORD))
+
+    if not _SPECIAL.search(word):
+        return LITERAL
+
+    try:
+        parsed = sre_parse.parse(word, re.U)
+        re.compile(word, re.U)
+    except (re.error, OverflowError, RuntimeError) as exc:
+        raise PatternError("invalid regex: {}".format(exc))
+
+    if _repeats(parsed) > MAX_REPEATS:
+        raise PatternError("more than {} unbounded repeats".format(
+            MAX_REPEATS))
+
+    return REGEX
+
+
+def _text(msg):
+    """Return a message as text."""
+    if isinstance(msg, bytes):
+        return msg.decode('utf8', 'replace')
+
+    return msg
+
+
+def _pattern(word, pattern):
+    """Return a word with its pattern compiled, to tell which word matched."""
+    return word, re.compile(pattern, re.I | re.U)
+
+
+def _join(patterns):
+    """Join compiled (word, pattern) pairs into one regex, or None."""
+    if not patterns:
+        return None
+
+    return re.compile(u"|".join(u"(?:%s)" % pattern.pattern
+        for word, pattern in patterns), re.I | re.U)
+
+
+class Matchers(object):
+    """Compiled badword matchers for many channels.
+
+    The words of every channel are compiled into a single alternation regex,
+    so checking a message costs one scan of the text however many words
+    there are. A second matcher with only the literal words of a channel is
+    used when the bot is overloaded and has to degrade to cheaper matching.
+    Matchers are compiled on first use and rebuilt when the words change.
+    They are compiled in the threads that check, so a matcher made from
+    words that changed in the meantime is used once but not kept.
+
+    Messages are folded once (see normalize). Literal words are folded the
+    same way and matched in folded form. Regexes are used as written and
+    matched against both the message as sent and its folded form, so that
+    \\d still matches digits that folding turns into letters.
+
+    When budget is set, a channel whose matcher takes longer than budget
+    seconds on a message falls back to its literal words until its words
+    change. Such overruns are queued in overruns as (channel, seconds).
+    """
+
+    def __init__(self, budget=None):
+        """Init"""
+        self._words = {}
+        self._versions = {}
+        self._version = 0
+        self._matchers = {}
+        self._slow = set()
+        self._lock = threading.Lock()
+        self.budget = budget
+        self.overruns = deque()
+
+    def set_words(self, channel, words):
+        """Replace the words of a channel."""
+        with self._lock:
+            self._version += 1
+            self._versions[channel] = self._version
+            self._words[channel] = list(words)
+            self._matchers.pop((channel, False), None)
+            self._matchers.pop((channel, True), None)
+            self._slow.discard(channel)
+
+    def clear(self):
+        """Forget the words of all channels."""
+        with self._lock:
+            self._words = {}
+            self._versions = {}
+            self._matchers = {}
+            self._slow = set()
+
+    def take_overruns(self):
+        """Remove and return the queued overruns."""
+        overruns = []
+
+        while self.overruns:
+            overruns.append(self.overruns.popleft())
+
+        return overruns
+
+    def _compile(self, channel, literal_only=False):
+        """Compile the words of a channel into at most two matchers.
+
+        Returns a list of (matcher, patterns, regex), where patterns is the
+        list of (word, compiled pattern) the matcher was made of and regex
+        tells whether it is the matcher of the regexes.
+        """
+        literals = []
+        regexes = []
+
+        with self._lock:
+            words = self._words.get(channel, ())
+            version = self._versions.get(channel)
+
+        for word in words:
+            if not _SPECIAL.search(word):
+                literals.append(_pattern(word, literal_pattern(word)))
+            elif not literal_only:
+                try:
+                    regexes.append(_pattern(word, uncapture(word)))
+                except (re.error, ValueError):
+                    # A broken pattern should not disable the whole list.
+                    literals.append(_pattern(word, literal_pattern(word)))
+
+        parts = []
+
+        if literals:
+            parts.append((_join(literals), literals, False))
+
+        try:
+            if regexes:
+                parts.append((_join(regexes), regexes, True))
+        except Exception:
+            # Keep matching the literal words, which always compile.
+            pass
+
+        with self._lock:
+            if self._versions.get(channel) == version:
+                self._matchers[channel, literal_only] = parts
+
+        return parts
+
+    def _word(self, match, patterns):
+        """Return the word whose pattern made a match."""
+        # The first alternative that matches where the match starts is the
+        # one the combined matcher took.
+        for word, pattern in patterns:
+            if pattern.match(match.string, match.start()):
+                return word
+
+        return match.group()
+
+    def check(self, channel, msg, literal_only=False):
+        """Return the word found in msg, or False."""
+        return self._check(channel, _text(msg), fold(msg), literal_only)
+
+    def _check(self, channel, raw, text, literal_only):
+        """Check a message as sent and folded."""
+        literal_only = literal_only or channel in self._slow
+
+        try:
+            parts = self._matchers[channel, literal_only]
+        except KeyError:
+            metrics.CACHE.inc(cache="matchers", result="miss")
+            parts = self._compile(channel, literal_only)
+        else:
+            metrics.CACHE.inc(cache="matchers", result="hit")
+
+        start = time.time()
+        found = self._search(parts, raw, text)
+        elapsed = time.time() - start
+
+        if self.budget is not None and not literal_only and \
+            elapsed > self.budget:
+            self._slow.add(channel)
+            self.overruns.append((channel, elapsed))
+
+        return found
+
+    def _search(self, parts, raw, text):
+        """Return the first word of parts found in a message, or False.
+
+        Literal words are looked for in the folded text. Regexes are tried
+        on the text as sent first, since folding turns digits and symbols
+        into letters, and then on the folded text to catch disguised words.
+        """
+        for matcher, patterns, regex in parts:
+            for subject in (raw, text) if regex else (text, ):
+                match = matcher.search(subject)
+
+                if match is not None:
+                    return self._word(match, patterns)
+
+        return False
+
+    def check_many(self, items, started=None):
+        """Check a list of (channel, msg, literal_only) in one go.
+
+        A message sent to many channels is only folded once. The verdict of
+        a message that could not be checked is None, so the other channels
+        of a batch still get theirs. started is called with the position of
+        every item whose channel differs from the one before.
+        """
+        folded = {}
+        verdicts = []
+        previous = None
+
+        for position, (channel, msg, literal_only) in enumerate(items):
+            if started is not None and channel != previous:
+                started(position)
+                previous = channel
+
+            try:
+                raw, text = folded[msg]
+            except KeyError:
+                raw, text = folded[msg] = _text(msg), fold(msg)
+
+            try:
+                verdicts.append(self._check(channel, raw, text,
+                    literal_only))
+            except Exception:
+                verdicts.append(None)
+
+        return verdicts
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Counters, gauges and histograms served in Prometheus text format."""
+
+import threading
+import time
+from twisted.web import resource
+
+
+# Seconds, from well below a regex scan to a slow database round trip.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    """Format a sorted tuple of label pairs."""
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\",
+        "\\\\").replace('"', '\\"')) for key, value in labels)
+
+
+class Metric(object):
+    """Base class of all metrics."""
+
+    kind = None
+
+    def __init__(self, registry, name, description):
+        """Init"""
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def render(self):
+        """Return the lines of the metric in text format."""
+        lines = ["# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.kind)]
+
+        with self._lock:
+            lines.extend(self._samples())
+
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, registry, name, description):
+        """Init"""
+        Metric.__init__(self, registry, name, description)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter."""
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Return the current value."""
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def _samples(self):
+        """Return the sample lines."""
+        return ["%s%s %s" % (self.name, _labels(key), value)
+            for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """A value that is read from a function when rendered."""
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, description):
+        """Init"""
+        Metric.__init__(self, registry, name, description)
+        self._functions = {}
+
+    def set_function(self, function, **labels):
+        """Read the value of the gauge from function."""
+        with self._lock:
+            self._functions[tuple(sorted(labels.items()))] = function
+
+    def _samples(self):
+        """Return the sample lines."""
+        samples = []
+
+        for key, function in sorted(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+
+            samples.append("%s%s %s" % (self.name, _labels(key), value))
+
+        return samples
+
+
+class Histogram(Metric):
+    """Observations counted in buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, description, buckets=DEFAULT_BUCKETS):
+        """Init"""
+        Metric.__init__(self, registry, name, description)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """Record an observation."""
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0.0
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+            self._values[key] = (counts, total + value)
+
+    def time(self, d, **labels):
+        """Observe how long it takes until a Deferred fires."""
+        start = time.time()
+
+        def observe(result):
+            """Record the duration and pass the result on."""
+            self.observe(time.time() - start, **labels)
+            return result
+
+        return d.addBoth(observe)
+
+    def _samples(self):
+        """Return the sample lines."""
+        samples = []
+
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ("+Inf", ), counts):
+                cumulative += count
+                samples.append("%s_bucket%s %d" % (self.name,
+                    _labels(key + (("le", bound), )), cumulative))
+
+            samples.append("%s_sum%s %r" % (self.name, _labels(key), total))
+            samples.append("%s_count%s %d" % (self.name, _labels(key),
+                cumulative))
+
+        return samples
+
+
+class Registry(object):
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        """Init"""
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric."""
+        self._metrics.append(metric)
+
+    def render(self):
+        """Return all metrics in Prometheus text format."""
+        lines = []
+
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsResource(resource.Resource):
+    """A web resource serving a registry."""
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        """Init"""
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        """Render the metrics."""
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        return self.registry.render().encode('utf8')
+
+
+REGISTRY = Registry()
+
+PRIVMSG_SECONDS = Histogram(REGISTRY, "teacherbot_privmsg_seconds",
+    "Time spent handling an incoming message on the reactor.")
+QUEUE_WAIT_SECONDS = Histogram(REGISTRY, "teacherbot_queue_wait_seconds",
+    "Time a message waits in the check queue.")
+CHECK_SECONDS = Histogram(REGISTRY, "teacherbot_check_seconds",
+    "Time to check a batch of messages, including the thread hop.")
+VERDICT_SECONDS = Histogram(REGISTRY, "teacherbot_verdict_seconds",
+    "Time from a message being queued until its verdict.")
+BADWORD_SECONDS = Histogram(REGISTRY, "teacherbot_badword_seconds",
+    "Time spent acting on a verdict.")
+COMMAND_SECONDS = Histogram(REGISTRY, "teacherbot_command_seconds",
+    "Time to run a command.")
+DB_SECONDS = Histogram(REGISTRY, "teacherbot_db_seconds",
+    "Time of a database operation, including waiting for a thread.")
+REJOIN_SECONDS = Histogram(REGISTRY, "teacherbot_rejoin_seconds",
+    "Time from connecting until all autojoin channels are joined.",
+    (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+
+MESSAGES = Counter(REGISTRY, "teacherbot_messages_total",
+    "Messages by what happened to them.")
+ACTIONS = Counter(REGISTRY, "teacherbot_actions_total",
+    "Moderation actions taken.")
+CACHE = Counter(REGISTRY, "teacherbot_cache_total",
+    "Cache lookups by cache and result.")
+CONNECTIONS = Counter(REGISTRY, "teacherbot_connections_total",
+    "Connections made and lost.")
+FLOODS = Counter(REGISTRY, "teacherbot_floods_total",
+    "Floods and repeated messages detected.")
+SLOW_MATCHES = Counter(REGISTRY, "teacherbot_slow_matches_total",
+    "Messages whose check went over the match time budget.")
+EVENTS = Counter(REGISTRY, "teacherbot_events_total",
+    "Moderation events written to or dropped from the event log.")
+
+QUEUE_DEPTH = Gauge(REGISTRY, "teacherbot_queue_depth",
+    "Messages waiting in the check queue.")
+OUTBOUND_QUEUE = Gauge(REGISTRY, "teacherbot_outbound_queue",
+    "Lines waiting to be sent to the server.")
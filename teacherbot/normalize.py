@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Normalization of messages before they are matched.
+
+Every message is folded once into a canonical form: lower case, accents
+and other combining marks removed, look-alike letters from other scripts
+and common leetspeak digits replaced by latin letters, invisible characters
+removed and runs of three or more equal characters shortened to two. Literal
+badwords are folded the same way, so "b4dw0rd", "baaaadword" and a word
+spelled with cyrillic letters all match "badword".
+"""
+
+import re
+import unicodedata
+
+
+# Look-alike letters from cyrillic and greek.
+CONFUSABLES = {
+    u"а": u"a", u"в": u"b", u"е": u"e", u"к": u"k",
+    u"м": u"m", u"н": u"h", u"о": u"o", u"р": u"p",
+    u"с": u"c", u"т": u"t", u"у": u"y", u"х": u"x",
+    u"і": u"i", u"ј": u"j", u"ѕ": u"s", u"ԁ": u"d",
+    u"ɡ": u"g", u"α": u"a", u"β": u"b", u"ε": u"e",
+    u"ι": u"i", u"κ": u"k", u"ν": u"v", u"ο": u"o",
+    u"ρ": u"p", u"τ": u"t", u"υ": u"u", u"χ": u"x",
+    }
+
+# Digits and symbols used as letters.
+LEETSPEAK = {
+    u"0": u"o", u"1": u"i", u"3": u"e", u"4": u"a", u"5": u"s", u"7": u"t",
+    u"8": u"b", u"@": u"a", u"$": u"s",
+    }
+
+# Characters that don't show and are used to split words.
+INVISIBLE = (u"\u00ad", u"\u200b", u"\u200c", u"\u200d", u"\u2060",
+    u"\ufeff")
+
+
+def _table():
+    """Build the translation table used by fold."""
+    table = dict((ord(char), replacement) for char, replacement in
+        list(CONFUSABLES.items()) + list(LEETSPEAK.items()))
+    table.update((ord(char), None) for char in INVISIBLE)
+    return table
+
+
+TABLE = _table()
+
+_REPEATS = re.compile(r"(.)\1\1+", re.U | re.S)
+_RUNS = re.compile(r"(.)\1*", re.U | re.S)
+
+
+def fold(text):
+    """Return the normalized form of a message or a literal word."""
+    if isinstance(text, bytes):
+        text = text.decode('utf8', 'replace')
+
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = u"".join(char for char in text if not unicodedata.combining(char))
+    return _REPEATS.sub(r"\1\1", text.translate(TABLE))
+
+
+def literal_pattern(word):
+    """Return a regex matching a literal word in folded text.
+
+    Every run of a letter in the folded word may be repeated in the text,
+    so "bad" matches "baad" but "ass" still needs two s.
+    """
+    return u"".join(re.escape(match.group(1)) * len(match.group(0)) + u"+"
+        for match in _RUNS.finditer(fold(word)))
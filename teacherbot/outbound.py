@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from twisted.internet import reactor
+
+
+# Priority classes, most urgent first.
+CONTROL = 0
+MODERATION = 1
+WARNING = 2
+REPLY = 3
+
+PRIORITIES = (CONTROL, MODERATION, WARNING, REPLY)
+
+# The longest line a server relays, including the prefix it adds and CRLF.
+MAX_LINE = 512
+
+# Room left for the prefix the server adds when relaying our lines.
+PREFIX_RESERVE = 100
+
+
+def pack(items, width, separator=", "):
+    """Pack strings into as few lines as possible of at most width bytes.
+
+    An item that is longer than a line on its own is cut.
+    """
+    lines = []
+    line = ""
+
+    for item in items:
+        item = item[:width]
+
+        if line and len(line) + len(separator) + len(item) <= width:
+            line += separator + item
+        else:
+            if line:
+                lines.append(line)
+
+            line = item
+
+    if line:
+        lines.append(line)
+
+    return lines
+
+
+def _join(channels, keys):
+    """Format a JOIN line."""
+    line = "JOIN " + ",".join(channels)
+
+    if keys:
+        line += " " + ",".join(keys)
+
+    return line
+
+
+def join_lines(channels, targets=None, width=MAX_LINE - 2):
+    """Pack (channel, key) pairs into as few JOIN lines as possible.
+
+    A line has at most targets channels and width bytes. Channels with a key
+    go first, as the keys of a JOIN line belong to its first channels.
+    """
+    lines = []
+    names = []
+    keys = []
+
+    for channel, key in sorted(channels, key=lambda pair: not pair[1]):
+        more_names = names + [channel]
+        more_keys = keys + [key] if key else keys
+
+        if names and (len(_join(more_names, more_keys)) > width or
+            targets and len(more_names) > targets):
+            lines.append(_join(names, keys))
+            names, keys = [channel], [key] if key else []
+        else:
+            names, keys = more_names, more_keys
+
+    if names:
+        lines.append(_join(names, keys))
+
+    return lines
+
+
+class _Class(object):
+    """The queued lines of one priority class."""
+
+    def __init__(self):
+        """Init"""
+        self.targets = {}
+        self.turns = deque()
+        self.keys = {}
+        self.size = 0
+
+
+class Scheduler(object):
+    """Sends lines by priority, paced by a token bucket.
+
+    Protocol lines go first, then moderation actions, then channel warnings
+    and last command replies, so a kick never waits behind a long help
+    listing. Within a class the targets take turns. The bucket holds up to
+    burst lines and refills with rate lines per second, which should match
+    the flood limits of the server; rate None sends everything at once.
+
+    A line queued with a key replaces the text of a queued line with the
+    same key, and a reply or warning that is already queued for the same
+    target is dropped, so obsolete notices don't pile up.
+    """
+
+    def __init__(self, send, rate=1.0, burst=4, clock=reactor):
+        """Init"""
+        self._send = send
+        self._clock = clock
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = clock.seconds()
+        self._classes = [_Class() for priority in PRIORITIES]
+        self._timer = None
+        self.sent = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        """Return the number of queued lines."""
+        return sum(cls.size for cls in self._classes)
+
+    def put(self, line, priority=CONTROL, target=None, key=None):
+        """Queue a line."""
+        if not self.rate:
+            self._send(line)
+            self.sent += 1
+            return
+
+        cls = self._classes[priority]
+
+        if key is None and priority >= WARNING:
+            key = (target, line)
+
+        if key is not None:
+            entry = cls.keys.get(key)
+
+            if entry is not None:
+                entry[0] = line
+                self.coalesced += 1
+                return
+
+        entry = [line, key]
+
+        if key is not None:
+            cls.keys[key] = entry
+
+        if target not in cls.targets:
+            cls.targets[target] = deque()
+            cls.turns.append(target)
+
+        cls.targets[target].append(entry)
+        cls.size += 1
+
+        if self._timer is None:
+            self._pump()
+
+    def clear(self):
+        """Drop everything that is queued."""
+        self._classes = [_Class() for priority in PRIORITIES]
+
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+
+        self._timer = None
+
+    def _take(self):
+        """Remove and return the next line to send."""
+        for cls in self._classes:
+            if cls.size:
+                target = cls.turns.popleft()
+                queue = cls.targets[target]
+                line, key = queue.popleft()
+                cls.size -= 1
+
+                if key is not None:
+                    del cls.keys[key]
+
+                if queue:
+                    cls.turns.append(target)
+                else:
+                    del cls.targets[target]
+
+                return line
+
+    def _refill(self):
+        """Add the tokens earned since last time."""
+        now = self._clock.seconds()
+        self._tokens = min(float(self.burst),
+            self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _pump(self):
+        """Send as many lines as the bucket allows."""
+        self._timer = None
+        self._refill()
+
+        while self._tokens >= 1 and len(self):
+            self._tokens -= 1
+            self._send(self._take())
+            self.sent += 1
+
+        if len(self) and self._timer is None:
+            self._timer = self._clock.callLater(
+                (1 - self._tokens) / self.rate, self._pump)
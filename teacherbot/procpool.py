@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import zlib
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log
+from worker import pack, unpack
+
+
+# Extra seconds a worker gets on top of the budget of a batch.
+SLACK = 1.0
+
+
+class Overrun(Exception):
+    """A worker was killed for running over the budget of a batch.
+
+    channel is the channel it was matching then, or None if that isn't
+    known or only literal words were matched.
+    """
+
+    def __init__(self, channel, seconds):
+        """Init"""
+        Exception.__init__(self, channel, seconds)
+        self.channel = channel
+        self.seconds = seconds
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """The connection to one matcher worker process."""
+
+    def __init__(self, pool, index):
+        """Init"""
+        self.pool = pool
+        self.index = index
+        self._buffer = b""
+        self._pending = {}
+        self._batches = {}
+        self._current = None
+        self._next = 0
+        self._reason = None
+        self.alive = True
+
+    def connectionMade(self):
+        """Send the words of the channels this worker is responsible for."""
+        for channel, words in self.pool.shard_words(self.index):
+            self.send(("words", channel, words))
+
+    def send(self, message):
+        """Send a message to the worker."""
+        if self._reason is None:
+            self.transport.write(pack(message))
+
+    def check_many(self, items, timeout=None):
+        """Ask the worker for the verdicts of a batch.
+
+        The worker is killed if it hasn't answered within timeout seconds.
+        """
+        if self._reason is not None:
+            return defer.fail(self._reason)
+
+        self._next += 1
+        d = self._pending[self._next] = defer.Deferred()
+        self._batches[self._next] = items
+        self.send(("check", self._next, items))
+
+        if timeout is not None:
+            timer = reactor.callLater(timeout, self._expired, self._next,
+                timeout)
+            d.addBoth(self._cancel, timer)
+
+        return d
+
+    def _cancel(self, result, timer):
+        """Stop the timer of a check that is done."""
+        if timer.active():
+            timer.cancel()
+
+        return result
+
+    def _expired(self, check_id, timeout):
+        """Called when a check has run out of time."""
+        if check_id in self._pending and self.transport is not None:
+            channel = self._matching()
+            log.msg("Matcher worker {} is over its budget in {}, killing "
+                "it".format(self.index, channel))
+            self.alive = False
+            self._batches.pop(check_id)
+            self._pending.pop(check_id).errback(Overrun(channel, timeout))
+            self.transport.signalProcess("KILL")
+
+    def _matching(self):
+        """Return the channel the worker is matching regexes for, or None."""
+        if self._current is None:
+            return None
+
+        check_id, position = self._current
+        items = self._batches.get(check_id)
+
+        if items is None:
+            return None
+
+        channel, msg, literal_only = items[position]
+        return None if literal_only else channel
+
+    def outReceived(self, data):
+        """Called with progress and verdicts from the worker."""
+        messages, self._buffer = unpack(self._buffer + data)
+
+        for message in messages:
+            if len(message) == 2:
+                # The worker started on the items of another channel.
+                self._current = message
+                continue
+
+            check_id, verdicts, overruns = message
+            self.pool.report(overruns)
+            self._batches.pop(check_id)
+            self._pending.pop(check_id).callback(verdicts)
+
+    def errReceived(self, data):
+        """Called when the worker writes to stderr."""
+        log.msg("Matcher worker {}: {}".format(self.index, data))
+
+    def processEnded(self, reason):
+        """Called when the worker exits."""
+        self._reason = reason
+        self.alive = False
+        self._batches = {}
+        pending, self._pending = self._pending, {}
+
+        for d in pending.values():
+            d.errback(reason)
+
+        self.pool.ended(self, reason)
+
+
+class ProcessPool(object):
+    """Matchers running in a pool of worker processes.
+
+    Regex matching is CPU bound and threads don't help because of the GIL,
+    so the channels are sharded across worker processes instead. Each worker
+    keeps compiled matchers for its own channels and gets the word lists
+    from here, and a worker that dies is restarted with its lists.
+
+    With a budget, the workers enforce it per message themselves, and a
+    worker stuck in a single match is killed once a batch takes longer
+    than the budget of all its messages. The channel it was matching is
+    then only checked for literal words until its words change. Overruns
+    are passed to report as a list of (channel, seconds).
+
+    Checks for a worker that is being restarted wait for the new one. A
+    batch that got its worker killed is checked again once the channel is
+    demoted, and a batch that failed otherwise is tried once more before
+    its verdicts are given as None.
+    """
+
+    def __init__(self, size, budget=None, report=None):
+        """Init"""
+        self._words = {}
+        self._workers = [None] * size
+        self._running = True
+        self._slow = set()
+        self._held = [[] for index in range(size)]
+        self.budget = budget
+        self.report = report or (lambda overruns: None)
+
+        for index in range(size):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        """Start the worker process for a shard."""
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))] +
+            env.get("PYTHONPATH", "").split(os.pathsep))
+
+        args = [sys.executable, "-m", "teacherbot.worker"]
+
+        if self.budget is not None:
+            args.append(repr(self.budget))
+
+        self._workers[index] = WorkerProtocol(self, index)
+        reactor.spawnProcess(self._workers[index], sys.executable, args,
+            env=env)
+        held, self._held[index] = self._held[index], []
+
+        for d in held:
+            d.callback(None)
+
+    def _shard(self, channel):
+        """Return the index of the worker responsible for a channel."""
+        if not isinstance(channel, bytes):
+            channel = channel.encode('utf8')
+
+        return (zlib.crc32(channel) & 0xffffffff) % len(self._workers)
+
+    def shard_words(self, index):
+        """Return the (channel, words) pairs of a shard."""
+        return [(channel, words) for channel, words in self._words.items()
+            if self._shard(channel) == index]
+
+    def set_words(self, channel, words):
+        """Replace the words of a channel."""
+        self._words[channel] = list(words)
+        self._slow.discard(channel)
+        self._workers[self._shard(channel)].send(("words", channel,
+            self._words[channel]))
+
+    def clear(self):
+        """Forget the words of all channels."""
+        self._words = {}
+        self._slow = set()
+
+        for worker in self._workers:
+            worker.send(("clear", ))
+
+    def check_many(self, items):
+        """Check a list of (channel, msg, literal_only).
+
+        The batch is split per worker and the verdicts are put back in order.
+        """
+        shards = {}
+        verdicts = [None] * len(items)
+
+        for position, item in enumerate(items):
+            shards.setdefault(self._shard(item[0]), []).append(position)
+
+        def fill(results, positions):
+            """Put the verdicts of a worker in place."""
+            for position, verdict in zip(positions, results):
+                verdicts[position] = verdict
+
+        checks = []
+
+        for index, positions in shards.items():
+            # The worker tells when it starts on another channel, so it
+            # gets the items of each channel together.
+            positions.sort(key=lambda position: items[position][0])
+            d = self._check(index, [items[position] for position in
+                positions])
+            checks.append(d.addCallback(fill, positions))
+
+        return defer.gatherResults(checks).addCallback(lambda result:
+            verdicts)
+
+    def _check(self, index, batch, retry=True):
+        """Check a batch on a worker, waiting for it if it is restarting."""
+        worker = self._workers[index]
+
+        if not self._running:
+            return defer.succeed([None] * len(batch))
+
+        if not worker.alive:
+            d = defer.Deferred()
+            self._held[index].append(d)
+            return d.addCallback(lambda result: self._check(index, batch,
+                retry))
+
+        items = [(channel, msg, literal_only or channel in self._slow)
+            for channel, msg, literal_only in batch]
+        timeout = None
+
+        if self.budget is not None:
+            timeout = self.budget * len(items) + SLACK
+
+        def failed(failure):
+            """Demote the channel that got the worker killed and retry."""
+            if failure.check(Overrun) and failure.value.channel is not None:
+                # The channel is literal only from now on, so this can't
+                # happen again for it.
+                self._slow.add(failure.value.channel)
+                self.report([(failure.value.channel, failure.value.seconds)])
+                return self._check(index, batch, retry)
+
+            log.err(failure, "Matcher worker failed a batch")
+
+            if retry:
+                return self._check(index, batch, False)
+
+            return [None] * len(batch)
+
+        return worker.check_many(items, timeout).addErrback(failed)
+
+    def ended(self, worker, reason):
+        """Called when a worker exits; restarts it unless stopping."""
+        if self._running and self._workers[worker.index] is worker:
+            log.err(reason, "Matcher worker {} died, restarting".format(
+                worker.index))
+            reactor.callLater(1, self._spawn, worker.index)
+
+    def stop(self):
+        """Stop all workers."""
+        self._running = False
+        held, self._held = self._held, [[] for worker in self._workers]
+
+        for waiting in held:
+            for d in waiting:
+                d.callback(None)
+
+        for worker in self._workers:
+            if worker.transport is not None:
+                worker.transport.closeStdin()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import metrics
+
+
+class Session(object):
+    """The permissions of an authenticated user."""
+
+    __slots__ = ("username", "network", "nick", "role", "channels", "all")
+
+    def __init__(self, user_doc):
+        """Init"""
+        self.username = user_doc["username"]
+        self.network = user_doc.get("network")
+        self.nick = user_doc["nick"]
+        self.role = dict(user_doc["role"])
+        self.channels = frozenset(user_doc["channels"])
+        self.all = user_doc["all"]
+
+
+class SessionTable(object):
+    """A table of sessions keyed by network and hostmask.
+
+    The same ident@host can be someone else on another network, so a
+    session only counts on the network it was authenticated on. A hostmask
+    that is known not to be authenticated on a network is stored as None so
+    that unknown users don't cause a database lookup on every command either.
+    Entries expire after ttl seconds and are then read from database again,
+    which picks up changes made by others.
+
+    The nick and hostmask of every logged in user are also indexed by
+    username and by network and nick, since the same nick can belong to
+    different people on different networks. The index doesn't expire, so
+    quits and nick changes of logged in users can be recognized without a
+    database lookup. Logins stored without a network match on any network.
+    """
+
+    def __init__(self, ttl=300, clock=time.time):
+        """Init"""
+        self.ttl = ttl
+        self._clock = clock
+        self._sessions = {}
+        self._logins = {}
+        self._nicks = {}
+        self._lock = threading.Lock()
+
+    def get(self, hostmask, network=None):
+        """Return the session for hostmask on a network.
+
+        Raises KeyError if the hostmask isn't known or the entry has expired.
+        """
+        with self._lock:
+            for key in ((network, hostmask), (None, hostmask)):
+                if key in self._sessions:
+                    break
+            else:
+                metrics.CACHE.inc(cache="sessions", result="miss")
+                raise KeyError(hostmask)
+
+            expires, session = self._sessions[key]
+
+            if expires < self._clock():
+                del self._sessions[key]
+                metrics.CACHE.inc(cache="sessions", result="expired")
+                raise KeyError(hostmask)
+
+        metrics.CACHE.inc(cache="sessions", result="hit")
+        return session
+
+    def set(self, hostmask, user_doc, network=None):
+        """Store the session of a user document, or None for no session.
+
+        A session is stored for the network of the user document, None is
+        stored for the network given.
+        """
+        expires = self._clock() + self.ttl
+
+        with self._lock:
+            if user_doc is None:
+                session = None
+            else:
+                session = Session(user_doc)
+                network = session.network
+                self._drop(session.username)
+                self._logins[session.username] = (session.network,
+                    session.nick, hostmask)
+                self._nicks[session.network, session.nick] = session.username
+
+            self._sessions[network, hostmask] = (expires, session)
+
+        return session
+
+    def update(self, user_doc):
+        """Refresh the session of a user after its document was changed."""
+        if user_doc.get("hostmask"):
+            self.set(user_doc["hostmask"], user_doc)
+        else:
+            self.drop_username(user_doc["username"])
+
+    def drop(self, hostmask, network=None):
+        """Remove the session of a hostmask on a network."""
+        with self._lock:
+            self._sessions.pop((network, hostmask), None)
+
+    def drop_username(self, username):
+        """Remove the session of a user."""
+        with self._lock:
+            self._drop(username)
+
+    def drop_nick(self, network, nick):
+        """Remove the session of a nick, e.g. when it leaves the network.
+
+        Returns the username that was logged in with the nick, or None.
+        """
+        with self._lock:
+            key = self._key(network, nick)
+
+            if key is None:
+                return None
+
+            username = self._nicks[key]
+            self._drop(username)
+
+        return username
+
+    def rename(self, network, oldname, newname):
+        """Follow a nick change.
+
+        Returns the username that is logged in with the nick, or None.
+        """
+        with self._lock:
+            key = self._key(network, oldname)
+
+            if key is None:
+                return None
+
+            username = self._nicks.pop(key)
+            network, nick, hostmask = self._logins[username]
+            self._logins[username] = (network, newname, hostmask)
+            self._nicks[network, newname] = username
+            expires, session = self._sessions.get((network, hostmask),
+                (None, None))
+
+            if session is not None:
+                session.nick = newname
+
+        return username
+
+    def _key(self, network, nick):
+        """Return the index key of a nick, or None. Lock must be held."""
+        for key in ((network, nick), (None, nick)):
+            if key in self._nicks:
+                return key
+
+        return None
+
+    def _drop(self, username):
+        """Forget the login and session of a user. Lock must be held."""
+        try:
+            network, nick, hostmask = self._logins.pop(username)
+        except KeyError:
+            return
+
+        if self._nicks.get((network, nick)) == username:
+            del self._nicks[network, nick]
+
+        expires, session = self._sessions.get((network, hostmask),
+            (None, None))
+
+        if session is not None and session.username == username:
+            del self._sessions[network, hostmask]
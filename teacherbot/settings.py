@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+
+def encode(value):
+    """Return value as an utf8 encoded string."""
+    if isinstance(value, bytes):
+        return value
+
+    return value.encode('utf8')
+
+
+class ChannelSettings(object):
+    """The settings of a channel.
+
+    String options are kept utf8 encoded so they can be formatted and sent
+    as they are, without encoding them again for every warning or kick.
+
+    networks lists the networks an autojoin channel is joined on; when it is
+    empty the channel is joined on all of them.
+    """
+
+    BOOLEANS = ("kicker", "ban", "private", "autojoin")
+    INTEGERS = ("ttb", "ttk", "bantime", "flood_lines", "flood_seconds",
+        "repeats", "repeat_seconds")
+    STRINGS = ("cmd_atb", "cmd_kick", "chanserv", "kick_reason",
+        "ban_reason", "warning", "key", "flood_warning")
+    LISTS = ("networks", )
+
+    __slots__ = ("channel", ) + BOOLEANS + INTEGERS + STRINGS + LISTS
+
+    DEFAULTS = {
+        "ttb": 3,
+        "ttk": 3,
+        "kicker": False,
+        "ban": False,
+        "private": True,
+        "autojoin": True,
+        "bantime": 60,
+        "flood_lines": 5,
+        "flood_seconds": 3,
+        "repeats": 3,
+        "repeat_seconds": 60,
+        "cmd_atb": "",
+        "cmd_kick": "",
+        "chanserv": "ChanServ",
+        "kick_reason": "Watch your language!",
+        "ban_reason": "Watch your language!",
+        "warning": "Watch your language!",
+        "flood_warning": "Don't flood!",
+        "key": "",
+        "networks": ()
+        }
+
+    def __init__(self, channel, **options):
+        """Init"""
+        self.channel = channel
+
+        for option in self.__slots__[1:]:
+            self.set(option, options.get(option, self.DEFAULTS[option]))
+
+    @classmethod
+    def from_doc(cls, doc):
+        """Create settings from a chan_settings document."""
+        return cls(doc["channel"], **dict((k, v) for k, v in doc.items()
+            if k in cls.DEFAULTS))
+
+    def to_doc(self):
+        """Return the settings as a chan_settings document."""
+        doc = {"channel": self.channel}
+
+        for option in self.__slots__[1:]:
+            doc[option] = self.get(option)
+
+        return doc
+
+    def get(self, option):
+        """Return the value of an option the way it is stored in database."""
+        value = getattr(self, option)
+
+        if option in self.STRINGS:
+            return value.decode('utf8')
+
+        if option in self.LISTS:
+            return sorted(item.decode('utf8') for item in value)
+
+        return value
+
+    def set(self, option, value):
+        """Set an option.
+
+        Raises KeyError for unknown options and ValueError for values of the
+        wrong type.
+        """
+        if option in self.BOOLEANS:
+            if value not in (True, False):
+                raise ValueError(value)
+
+            value = bool(value)
+        elif option in self.INTEGERS:
+            value = int(value)
+        elif option in self.STRINGS:
+            value = encode(value)
+        elif option in self.LISTS:
+            value = frozenset(encode(item) for item in value)
+        else:
+            raise KeyError(option)
+
+        setattr(self, option, value)
+
+    def items(self):
+        """Return a list of (option, value) pairs."""
+        return [(option, getattr(self, option)) for option in self.__slots__]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+import metrics
+
+
+class VerdictCache(object):
+    """A bounded LRU cache of verdicts that expire after ttl seconds.
+
+    Keys include a hash of the word list of the channel, so verdicts made
+    with an old list are never returned and simply age out.
+    """
+
+    def __init__(self, size=10000, ttl=60, clock=time.time):
+        """Init"""
+        self.size = size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Return the number of cached verdicts."""
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the verdict for key, or None if it isn't cached."""
+        try:
+            expires, verdict = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            metrics.CACHE.inc(cache="verdicts", result="miss")
+            return None
+
+        if expires < self._clock():
+            self.expired += 1
+            metrics.CACHE.inc(cache="verdicts", result="expired")
+            return None
+
+        # Put it back as the most recently used.
+        self._entries[key] = (expires, verdict)
+        self.hits += 1
+        metrics.CACHE.inc(cache="verdicts", result="hit")
+        return verdict
+
+    def put(self, key, verdict):
+        """Cache a verdict."""
+        if not self.size:
+            return
+
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock() + self.ttl, verdict)
+
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            metrics.CACHE.inc(cache="verdicts", result="evicted")
+
+    def clear(self):
+        """Drop all verdicts."""
+        self._entries = OrderedDict()
+
+    def stats(self):
+        """Return the counters of the cache."""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions
+            }
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Badword list files.
+
+A list file holds one word per line, utf8 encoded. Blank lines are skipped
+and surrounding whitespace is removed, so an exported list can be imported
+again as it is.
+"""
+
+import codecs
+import os
+from matcher import PatternError, classify
+
+
+def resolve(directory, name):
+    """Return the path of a list file named relative to directory.
+
+    Raises ValueError for absolute names and names that lead out of
+    directory, including through symlinks.
+    """
+    if not name or os.path.isabs(name) or ".." in name.replace("\\",
+        "/").split("/"):
+        raise ValueError("not a file name inside {}".format(directory))
+
+    base = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(base, name))
+
+    if not path.startswith(base + os.sep):
+        raise ValueError("not a file name inside {}".format(directory))
+
+    return path
+
+
+def read(path):
+    """Return the words of a list file."""
+    with codecs.open(path, "r", "utf8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write(path, words):
+    """Write words to a list file."""
+    with codecs.open(path, "w", "utf8") as f:
+        for word in words:
+            f.write(word + u"\n")
+
+
+def admit(words):
+    """Split words into the usable ones and the refused ones.
+
+    Returns a list of usable words without duplicates, in order, and a list
+    of (word, reason) for the words that can't be used.
+    """
+    usable = []
+    refused = []
+    seen = set()
+
+    for word in words:
+        if word in seen:
+            continue
+
+        seen.add(word)
+
+        try:
+            classify(word)
+        except PatternError as exc:
+            refused.append((word, str(exc)))
+        else:
+            usable.append(word)
+
+    return usable, refused
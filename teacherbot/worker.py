@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""A matcher worker process.
+
+Reads framed messages from stdin and writes the verdicts and the budget
+overruns to stdout for every check. With a budget it also writes the
+position of every item that starts the items of another channel, so the
+pool knows which channel was being matched if it has to kill the worker.
+Started by ProcessPool with python -m teacherbot.worker [budget].
+"""
+
+import marshal
+import struct
+import sys
+from teacherbot.matcher import Matchers
+
+
+_HEADER = struct.Struct("!I")
+
+
+def pack(message):
+    """Frame a message for the pipe."""
+    data = marshal.dumps(message)
+    return _HEADER.pack(len(data)) + data
+
+
+def unpack(buf):
+    """Split complete messages off a buffer.
+
+    Returns a list of messages and what is left of the buffer.
+    """
+    messages = []
+
+    while len(buf) >= _HEADER.size:
+        size, = _HEADER.unpack_from(buf)
+
+        if len(buf) < _HEADER.size + size:
+            break
+
+        messages.append(marshal.loads(buf[_HEADER.size:_HEADER.size + size]))
+        buf = buf[_HEADER.size + size:]
+
+    return messages, buf
+
+
+def read(stream):
+    """Yield the messages of a stream until it is closed."""
+    while True:
+        header = stream.read(_HEADER.size)
+
+        if len(header) < _HEADER.size:
+            return
+
+        size, = _HEADER.unpack(header)
+        yield marshal.loads(stream.read(size))
+
+
+def main():
+    """Serve checks until stdin is closed."""
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    matchers = Matchers(float(sys.argv[1]) if len(sys.argv) > 1 else None)
+
+    def send(message):
+        """Write a message to the pool."""
+        stdout.write(pack(message))
+        stdout.flush()
+
+    def progress(check_id):
+        """Return a function telling the pool where a check has got to."""
+        return lambda position: send((check_id, position))
+
+    for message in read(stdin):
+        if message[0] == "check":
+            started = None
+
+            if matchers.budget is not None:
+                started = progress(message[1])
+
+            verdicts = matchers.check_many(message[2], started)
+            send((message[1], verdicts, matchers.take_overruns()))
+        elif message[0] == "words":
+            matchers.set_words(message[1], message[2])
+        elif message[0] == "clear":
+            matchers.clear()
+
+
+if __name__ == "__main__":
+    main()
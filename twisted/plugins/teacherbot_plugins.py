@@ -6,10 +6,17 @@ from twisted.python import usage
 from twisted.plugin import IPlugin
 from twisted.application.service import IServiceMaker
 from twisted.application import service
-from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet import threads
 from twisted.python import log
+from twisted.web import server
 
 from teacherbot import BotFactory
+from teacherbot import metrics
+from teacherbot.changes import BADWORDS
+from teacherbot.core import Core, network_configs
+from teacherbot.database import open_backend
+from teacherbot import eventlog
+from teacherbot import wordlist
 import json
 
 
@@ -18,39 +25,195 @@ class Options(usage.Options):
     optParameters = [["config", "c", "config.json", "The configfile to use."], ]
 
 
+class WordsOptions(Options):
+    """Commandline options of teacherbot-words."""
+    optParameters = Options.optParameters + [
+        ["channel", None, None, "The channel whose blacklist to change."],
+        ["import", None, None, "Add the words of this file."],
+        ["export", None, None, "Write the words to this file."],
+        ["copy", None, None, "Add the words of this channel."],
+        ]
+
+    def postOptions(self):
+        """Check that one thing is asked for."""
+        if not self["channel"]:
+            raise usage.UsageError("--channel is required.")
+
+        if len([name for name in ("import", "export", "copy")
+            if self[name]]) != 1:
+            raise usage.UsageError("Give one of --import, --export or --copy.")
+
+
+class EventsOptions(Options):
+    """Commandline options of teacherbot-events."""
+    optParameters = Options.optParameters + [
+        ["by", None, "channel", "Comma separated fields to count by."],
+        ["events", None, None, "Comma separated events to count, e.g. kick."],
+        ]
+
+    def parseArgs(self, *paths):
+        """Take the event log files to read."""
+        self["paths"] = paths
+
+
 class BotService(service.Service):
-    """Custom service for IRC-Bot"""
+    """Custom service for IRC-Bot
+
+    Connects to every network in the config. All connections share one
+    core, so one database pool and one badword engine.
+    """
 
-    _bot = None
+    _core = None
+    _metrics = None
 
-    def __init__(self, config):
+    def __init__(self, config, options=None):
         """Init"""
         self.config = config
+        self._connectors = []
 
     def startService(self):
         """Start service"""
         from twisted.internet import reactor
 
-        def connected(bot):
-            """Called on success"""
-            self._bot = bot
+        if "metrics" in self.config:
+            self._metrics = reactor.listenTCP(self.config["metrics"]["port"],
+                server.Site(metrics.MetricsResource(metrics.REGISTRY)),
+                interface=self.config["metrics"].get("interface",
+                    "127.0.0.1"))
 
-        def failure(err):
-            """Called at error"""
-            log.err(err, _why='Could not connect to specified server.')
-            reactor.stop()
-
-        client = TCP4ClientEndpoint(reactor, self.config['network']["host"],
-            self.config['network']["port"])
-        factory = BotFactory(self.config)
+        self._core = Core(self.config)
+        self._core.start()
 
-        return client.connect(factory).addCallbacks(connected, failure)
+        # connectTCP rather than an endpoint, whose wrapping factory hides
+        # lost connections from the reconnecting BotFactory.
+        for network in network_configs(self.config):
+            factory = BotFactory(self.config, network, self._core)
+            self._connectors.append(reactor.connectTCP(network["host"],
+                network["port"], factory))
 
     def stopService(self):
         """Stop service"""
-        if self._bot and self._bot.transport.connected:
-            self._bot.transport.loseConnection()
-            self._bot.factory.dbclient.disconnect()
+        if self._metrics is not None:
+            self._metrics.stopListening()
+
+        for connector in self._connectors:
+            connector.factory.stopTrying()
+            connector.disconnect()
+
+        if self._core is not None:
+            self._core.stop()
+
+
+class TaskService(service.Service):
+    """Runs a task against the database once and stops."""
+
+    database = True
+
+    def __init__(self, config, options=None):
+        """Init"""
+        self.config = config
+        self.options = options
+
+    def startService(self):
+        """Start service"""
+        from twisted.internet import reactor
+
+        backend = None
+
+        if self.database:
+            backend = open_backend(self.config["database"])
+
+        def done(result):
+            """Called when the task is done or failed."""
+            if backend is not None:
+                backend.close()
+
+            reactor.stop()
+
+        d = threads.deferToThread(self.run, backend)
+        d.addCallbacks(log.msg, log.err)
+        d.addBoth(done)
+
+    def run(self, backend):
+        """Run the task in a thread. Returns a message for the log."""
+        raise NotImplementedError
+
+
+class MigrateService(TaskService):
+    """Creates the indexes of the database."""
+
+    def run(self, backend):
+        """Create the indexes."""
+        backend.ensure_indexes()
+        return "Indexes are up to date."
+
+
+class WordsService(TaskService):
+    """Imports, exports or copies a blacklist."""
+
+    def run(self, backend):
+        """Move the words."""
+        channel = self.options["channel"]
+
+        if self.options["export"]:
+            words = [doc["word"] for doc in backend.badwords(channel)]
+            wordlist.write(self.options["export"], words)
+            return "Wrote {} words to {}.".format(len(words),
+                self.options["export"])
+
+        if self.options["import"]:
+            words = wordlist.read(self.options["import"])
+        else:
+            words = [doc["word"] for doc in
+                backend.badwords(self.options["copy"])]
+
+        words, refused = wordlist.admit(words)
+
+        for word, reason in refused:
+            log.msg(u"Refused {!r}: {}".format(word, reason))
+
+        added = backend.add_badwords(words, channel)
+
+        if added:
+            backend.publish_change({"origin": "teacherbot-words",
+                "kind": BADWORDS, "key": channel})
+
+        return "Added {} words to {}, refused {}.".format(len(added),
+            channel, len(refused))
+
+
+class EventsService(TaskService):
+    """Counts the events in the moderation event log."""
+
+    database = False
+
+    def run(self, backend):
+        """Read the event log and count."""
+        paths = self.options["paths"]
+
+        if not paths:
+            path = self.config.get("events", {}).get("path")
+
+            if not path:
+                return "No event log configured and no files given."
+
+            paths = eventlog.rotated(path) + [path]
+
+        by = self.options["by"].split(",")
+        events = self.options["events"]
+        counts = eventlog.aggregate(paths, by,
+            events.split(",") if events else None)
+        lines = ["Events by {}:".format(", ".join(by))]
+
+        for key, counter in sorted(counts.items(),
+            key=lambda item: -sum(item[1].values())):
+            lines.append(u"{}: {} ({})".format(
+                " ".join(u"{}".format(value) for value in key),
+                sum(counter.values()),
+                ", ".join("{} {}".format(event, count)
+                    for event, count in counter.most_common())))
+
+        return u"\n".join(lines)
 
 
 class BotServiceMaker(object):
@@ -61,6 +224,7 @@ class BotServiceMaker(object):
     description = "Teacherbot - An IRC-Bot to that" \
         " helps you keep your channels clean."
     options = Options
+    service = BotService
 
     def makeService(self, options):
         """
@@ -70,6 +234,37 @@ class BotServiceMaker(object):
         with open(options['config'], "rb") as f:
             config = json.load(f)
 
-        return BotService(config)
+        return self.service(config, options)
+
+
+class MigrateServiceMaker(BotServiceMaker):
+    """Class to create the migration service."""
+
+    tapname = "teacherbot-migrate"
+    description = "Create the database indexes of Teacherbot. Run it once" \
+        " at install and after upgrades."
+    service = MigrateService
+
+
+class WordsServiceMaker(BotServiceMaker):
+    """Class to create the blacklist transfer service."""
+
+    tapname = "teacherbot-words"
+    description = "Import, export or copy the blacklist of a channel."
+    options = WordsOptions
+    service = WordsService
+
+
+class EventsServiceMaker(BotServiceMaker):
+    """Class to create the event log report service."""
+
+    tapname = "teacherbot-events"
+    description = "Count the moderation events in the event log per" \
+        " channel, word or any other field."
+    options = EventsOptions
+    service = EventsService
 
 botservice = BotServiceMaker()
+migrateservice = MigrateServiceMaker()
+wordsservice = WordsServiceMaker()
+eventsservice = EventsServiceMaker()